@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+"""Benchmarks of geoDL against local stand-ins of GEO, ENA and NCBI, so that they
+run offline and are comparable from one commit to the next.
+
+    python bench/bench.py                        # all the benchmarks
+    python bench/bench.py metadata --samples 10 1000 50000
+    python bench/bench.py download --files 8 --size 32M --jobs 1 4 8
+    python bench/bench.py prefetch --files 50 --jobs 1 4
+    python bench/bench.py --json now.json --compare before.json
+
+One threaded HTTP server plays GEO acc.cgi, the ENA warehouse search and
+filereport, eutils esearch/efetch and serves synthetic fastq.gz files with range
+requests. With pyftpdlib installed, the files are also served over FTP for the
+wget engine. Each case runs geoDL in its own process to report its peak RSS.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from geoDL import geoDL  # noqa: E402
+
+FILEREPORT_FIELDS = [
+    "study_accession",
+    "secondary_study_accession",
+    "sample_accession",
+    "secondary_sample_accession",
+    "experiment_accession",
+    "run_accession",
+    "sample_alias",
+    "scientific_name",
+    "instrument_model",
+    "library_layout",
+    "read_count",
+    "experiment_alias",
+    "run_alias",
+    "fastq_ftp",
+    "fastq_bytes",
+    "fastq_md5",
+]
+
+PREFETCH_SCRIPT = """#!{python}
+# stand-in of the NCBI prefetch: fetch the .sra of the run from the bench server
+import os, shutil, sys
+from urllib.request import urlopen
+srr = sys.argv[-1]
+out = sys.argv[sys.argv.index("-O") + 1] if "-O" in sys.argv else "."
+os.makedirs(os.path.join(out, srr))
+with open(os.path.join(out, srr, srr + ".sra"), "wb") as f:
+    shutil.copyfileobj(urlopen("{url}/sra/" + srr), f)
+"""
+
+
+def make_fastq(path, size, seed=0):
+    """Write a multi-member fastq.gz of about `size` bytes, return its size, md5
+    and number of reads"""
+    rand = random.Random(seed)
+    reads = 4000
+    block = "".join(
+        "@read{i}\n{seq}\n+\n{qual}\n".format(
+            i=i,
+            seq="".join(rand.choice("ACGT") for _ in range(100)),
+            qual="".join(rand.choice("?@ABCDEFGHI") for _ in range(100)),
+        )
+        for i in range(reads)
+    ).encode("ascii")
+    member = gzip.compress(block, 1)
+    n = max(1, size // len(member))
+    md5 = hashlib.md5()
+    with open(path, "wb") as f:
+        for _ in range(n):
+            f.write(member)
+            md5.update(member)
+    return n * len(member), md5.hexdigest(), n * reads
+
+
+SUBSERIES = 1000  # samples of each SubSeries of the big series
+
+
+class StandIn(ThreadingHTTPServer):
+    """Local GEO, ENA and eutils. Series GSE<n>, studies SRP<n> and projects
+    PRJNA<n> have n samples of one run each, whose fastq point in turn at the
+    served files. Studies ERP<n> point at the files on the FTP server. Series of
+    more than SUBSERIES samples are SuperSeries of GSE<n>S<k> in the SOFT export,
+    which is refused when the query has html=1"""
+
+    def __init__(self, files, sra_size=1024):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.url = "http://127.0.0.1:{}".format(self.server_address[1])
+        self.host = "127.0.0.1:{}".format(self.server_address[1])
+        self.files = files  # name -> (path, size, md5, reads)
+        self.sra = os.urandom(sra_size)
+        self.ftp_host = None
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def filereport(self, n, host):
+        names = sorted(self.files)
+        yield "\t".join(FILEREPORT_FIELDS) + "\n"
+        for i in range(n):
+            name = names[i % len(names)] if names else "none.fq.gz"
+            _, size, md5, reads = self.files.get(name, (None, 0, "", 0))
+            row = dict.fromkeys(FILEREPORT_FIELDS, "")
+            row.update(
+                study_accession="PRJNA{}".format(n),
+                secondary_study_accession="SRP{}".format(n),
+                sample_accession="SAMN{}".format(i),
+                experiment_accession="SRX{}".format(i),
+                run_accession="SRR{}".format(i),
+                sample_alias="GSM{}".format(i),
+                experiment_alias="GSM{}".format(i),
+                library_layout="SINGLE",
+                read_count=str(reads),
+                fastq_ftp="{}/files/{}".format(host, name),
+                fastq_bytes=str(size),
+                fastq_md5=md5,
+            )
+            yield "\t".join(row[field] for field in FILEREPORT_FIELDS) + "\n"
+
+    def geo_page(self, n):
+        yield "<html><body><table><tr><td>Samples ({})</td><td><table>".format(n)
+        for i in range(n):
+            yield "<tr><td>GSM{i}</td><td>sample {i}</td></tr>".format(i=i)
+        yield "</table></td></tr></table>"
+        yield "<a href='#'>PRJNA{}</a></body></html>".format(n)
+
+    def geo_soft(self, accession, targ):
+        m = re.match(r"GSE(\d+)(?:S(\d+))?$", accession)
+        if m is None:
+            return
+        n = int(m.group(1))
+        super_series = n > SUBSERIES and m.group(2) is None
+        if m.group(2) is None:
+            samples = range(n)
+        else:
+            k = int(m.group(2))
+            samples = range(k * SUBSERIES, min(n, (k + 1) * SUBSERIES))
+        if targ == "gsm":
+            if super_series:  # its samples are listed by its SubSeries
+                return
+            for i in samples:
+                yield "^SAMPLE = GSM{i}\n!Sample_title = sample {i}\n".format(i=i)
+                yield "!Sample_geo_accession = GSM{}\n".format(i)
+            return
+        yield "^SERIES = {}\n".format(accession)
+        for i in samples:
+            yield "!Series_sample_id = GSM{}\n".format(i)
+        if super_series:
+            for k in range((n + SUBSERIES - 1) // SUBSERIES):
+                yield "!Series_relation = SuperSeries of: GSE{}S{}\n".format(n, k)
+        yield (
+            "!Series_relation = BioProject: "
+            "https://www.ncbi.nlm.nih.gov/bioproject/PRJNA{}\n".format(n)
+        )
+
+    def efetch(self, n, start, count):
+        yield "<EXPERIMENT_PACKAGE_SET>"
+        for i in range(start, min(n, start + count)):
+            yield (
+                '<EXPERIMENT_PACKAGE><EXPERIMENT accession="SRX{i}"/><RUN_SET>'
+                '<RUN accession="SRR{i}" alias="GSM{i}" total_spots="10">'
+                '<Pool><Member member_name="" accession="SRS{i}" sample_name="GSM{i}"'
+                ' sample_title="sample {i}"/></Pool><Statistics nreads="1">'
+                '<Read index="0"/></Statistics></RUN></RUN_SET></EXPERIMENT_PACKAGE>'
+            ).format(i=i)
+        yield "</EXPERIMENT_PACKAGE_SET>"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def number(self, query):
+        m = re.search(r"(?:GSE|SRP|ERP|PRJNA)(\d+)", query)
+        return int(m.group(1)) if m else 0
+
+    def reply(self, parts, ctype="text/plain"):
+        body = "".join(parts).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.answer(dict(parse_qsl(self.rfile.read(length).decode("utf-8"))))
+
+    def do_GET(self):
+        self.answer(dict(parse_qsl(urlparse(self.path).query)))
+
+    def do_HEAD(self):
+        self.answer({}, head=True)
+
+    def answer(self, query, head=False):
+        server = self.server
+        path = urlparse(self.path).path
+        if path.endswith("/acc.cgi") and query.get("form") == "text":
+            if query.get("html"):
+                self.send_error(404)
+                return
+            self.reply(server.geo_soft(query.get("acc", ""), query.get("targ")))
+        elif path.endswith("/acc.cgi"):
+            self.reply(server.geo_page(self.number(query.get("acc", ""))), "text/html")
+        elif path.endswith("/warehouse/search"):
+            self.reply(
+                [
+                    "<ROOT><STUDY><IDENTIFIERS><SECONDARY_ID>SRP{}"
+                    "</SECONDARY_ID></IDENTIFIERS></STUDY></ROOT>".format(
+                        self.number(query.get("query", ""))
+                    )
+                ],
+                "text/xml",
+            )
+        elif path.endswith("/filereport"):
+            accession = query.get("accession", "")
+            host = server.ftp_host if accession.startswith("ERP") else server.host
+            self.reply(server.filereport(self.number(accession), host))
+        elif path.endswith("/esearch.fcgi"):
+            self.reply(
+                [
+                    "<eSearchResult><Count>{}</Count><QueryKey>1</QueryKey>"
+                    "<WebEnv>{}</WebEnv></eSearchResult>".format(
+                        self.number(query.get("term", "")), query.get("term", "")
+                    )
+                ],
+                "text/xml",
+            )
+        elif path.endswith("/efetch.fcgi"):
+            self.reply(
+                server.efetch(
+                    self.number(query.get("WebEnv", "")),
+                    int(query.get("retstart", 0)),
+                    int(query.get("retmax", 0)),
+                ),
+                "text/xml",
+            )
+        elif path.startswith("/sra/"):
+            self.reply([server.sra.decode("latin-1")])
+        elif path.startswith("/files/") and path[7:] in server.files:
+            self.send_file(server.files[path[7:]][0], head)
+        else:
+            self.send_error(404)
+
+    def send_file(self, path, head):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        m = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if m:
+            start, end = int(m.group(1)), int(m.group(2) or size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if head:
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = f.read(min(1 << 20, left))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                left -= len(chunk)
+
+
+def start_ftp(root):
+    """Serve `root` over anonymous FTP when pyftpdlib is installed, return the
+    host:port or None"""
+    try:
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+    except ImportError:
+        return None
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    handler = type("Handler", (FTPHandler,), {"authorizer": authorizer})
+    server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "127.0.0.1:{}".format(server.address[1])
+
+
+def run_case(spec):
+    """Child side: point geoDL at the stand-in, run one case, print its result"""
+    url = spec["url"]
+    geoDL.GEO_URL = url + "/geo/query/acc.cgi?acc={}"
+    if spec.get("html"):  # the fallback on the HTML page
+        geoDL.GEO_URL = url + "/geo/query/acc.cgi?html=1&acc={}"
+    geoDL.ENA_SEARCH_URL = geoDL.ENA_SEARCH_URL.replace("http://www.ebi.ac.uk", url)
+    geoDL.FILEREPORT_URL = geoDL.FILEREPORT_URL.replace("http://www.ebi.ac.uk", url)
+    geoDL.EUTILS_URL = url + "/eutils/"
+    sys.argv = ["geoDL"] + spec["argv"]
+    args = geoDL.get_args()
+    result = {}
+    devnull = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        start = time.time()
+        metafile, map_dict = geoDL.get_metadata(args)
+        result["resolve"] = time.time() - start
+        start = time.time()
+        table = geoDL.MetaTable(metafile, args.colname)
+        result["load"] = time.time() - start
+        result["rows"] = len(table)
+        if spec["kind"] != "metadata":
+            start = time.time()
+            if args.mode == "prefetch":
+                geoDL.prefetch_dl(args, table, map_dict)
+            else:
+                geoDL.ena_dl(args, table, map_dict)
+            result["download"] = time.time() - start
+            events = [
+                e
+                for e in geoDL.EventLog.of(args).events
+                if e["event"] in ("transfer", "prefetch")
+            ]
+            result["files"] = len(events)
+            result["failed"] = sum(1 for e in events if e["exit"] != 0)
+            result["bytes"] = sum(e["bytes"] or 0 for e in events)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    result["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if sys.platform == "darwin":  # already in bytes
+        result["rss"] //= 1024
+    print(json.dumps(result))
+
+
+def case(name, spec, env=None):
+    """Parent side: run a case in a child process, return its result"""
+    out = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), "_case", json.dumps(spec)],
+        env=env,
+    )
+    result = json.loads(out.decode("utf-8").strip().splitlines()[-1])
+    result["case"] = name
+    return result
+
+
+def fresh_dir(root, name):
+    path = os.path.join(root, name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+
+def bench_metadata(server, root, options):
+    results = []
+    for n in options.samples:
+        for name, mode, acc in [
+            ("geo", "geo", "GSE"),
+            ("geo-html", "geo", "GSE"),
+            ("ena", "ena", "SRP"),
+            ("prefetch", "prefetch", "GSE"),
+        ]:
+            work = fresh_dir(root, "meta")
+            argv = [mode, "{}{}".format(acc, n), "-o", work]
+            argv += ["--cache-dir", os.path.join(work, "cache"), "--cache-size", "0"]
+            result = case(
+                "metadata {} {}".format(name, n),
+                {
+                    "kind": "metadata",
+                    "url": server.url,
+                    "argv": argv,
+                    "html": name == "geo-html",
+                },
+            )
+            results.append(result)
+            report(result, "{rows} rows, resolve {resolve:.2f}s, load {load:.2f}s")
+    return results
+
+
+def bench_download(server, root, options):
+    engines = [("native", "SRP")] + ([("wget", "ERP")] if server.ftp_host else [])
+    results = []
+    for engine, study in engines:
+        for jobs in options.jobs:
+            work = fresh_dir(root, "download")
+            argv = ["ena", "{}{}".format(study, options.files), "-o", work]
+            argv += ["--cache-dir", os.path.join(work, "cache"), "--cache-size", "0"]
+            argv += ["--engine", engine, "--protocol", "http", "--jobs", str(jobs)]
+            argv += ["--segments", str(options.segments)]
+            argv += ["--host-connections", str(max(jobs, 1) * options.segments)]
+            result = case(
+                "download {} jobs={}".format(engine, jobs),
+                {"kind": "download", "url": server.url, "argv": argv},
+            )
+            result["throughput"] = result["bytes"] / result["download"]
+            results.append(result)
+            report(
+                result,
+                "{files} files, {failed} failed, {size} in {download:.2f}s, {rate}/s",
+            )
+    return results
+
+
+def bench_prefetch(server, root, options):
+    bindir = fresh_dir(root, "bin")
+    script = os.path.join(bindir, "prefetch")
+    with open(script, "w") as f:
+        f.write(PREFETCH_SCRIPT.format(python=sys.executable, url=server.url))
+    os.chmod(script, 0o755)
+    env = dict(os.environ, PATH=bindir + os.pathsep + os.environ.get("PATH", ""))
+    results = []
+    for jobs in options.jobs:
+        work = fresh_dir(root, "prefetch")
+        argv = ["prefetch", "GSE{}".format(options.files), "-o", work]
+        argv += ["--cache-dir", os.path.join(work, "cache"), "--cache-size", "0"]
+        argv += ["--jobs", str(jobs)]
+        result = case(
+            "prefetch jobs={}".format(jobs),
+            {"kind": "prefetch", "url": server.url, "argv": argv},
+            env,
+        )
+        results.append(result)
+        report(result, "{files} runs, {failed} failed in {download:.2f}s")
+    return results
+
+
+def report(result, fmt):
+    fields = dict(result)
+    fields["size"] = geoDL.format_size(result.get("bytes", 0))
+    fields["rate"] = geoDL.format_size(result.get("throughput", 0))
+    print(
+        "{:<28} {:<52} peak RSS {}".format(
+            result["case"], fmt.format(**fields), geoDL.format_size(result["rss"])
+        )
+    )
+    sys.stdout.flush()
+
+
+def compare(results, baseline, tolerance):
+    """Print the cases that got slower or fatter than `baseline`, return their
+    number"""
+    before = {r["case"]: r for r in baseline}
+    worse = 0
+    for result in results:
+        old = before.get(result["case"])
+        if old is None:
+            continue
+        for metric in ["resolve", "load", "download", "rss"]:
+            if metric in result and old.get(metric):
+                ratio = result[metric] / old[metric]
+                if ratio > 1 + tolerance:
+                    worse += 1
+                    print(
+                        "REGRESSION {} {}: {:.3g} -> {:.3g} (x{:.2f})".format(
+                            result["case"], metric, old[metric], result[metric], ratio
+                        )
+                    )
+    return worse
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "_case":
+        return run_case(json.loads(sys.argv[2]))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="Benchmarks to run among metadata, download and prefetch (all)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        nargs="+",
+        default=[10, 1000, 50000],
+        help="Sizes of the series for the metadata benchmark (10 1000 50000)",
+    )
+    parser.add_argument(
+        "--files", type=int, default=8, help="Number of files to download (8)"
+    )
+    parser.add_argument(
+        "--size",
+        type=geoDL.parse_size,
+        default=geoDL.parse_size("32M"),
+        help="Size of each synthetic fastq.gz (32M)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        nargs="+",
+        default=[1, 4, 8],
+        help="--jobs settings of the download benchmarks (1 4 8)",
+    )
+    parser.add_argument(
+        "--segments", type=int, default=4, help="--segments of the native engine (4)"
+    )
+    parser.add_argument("--workdir", help="Keep the files there instead of a tmpdir")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Results of a previous --json run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Slowdown flagged as a regression by --compare (0.25)",
+    )
+    options = parser.parse_args()
+    benchmarks = options.benchmarks or ["metadata", "download", "prefetch"]
+    for benchmark in benchmarks:
+        if benchmark not in ["metadata", "download", "prefetch"]:
+            parser.error("unknown benchmark {}".format(benchmark))
+
+    root = options.workdir or tempfile.mkdtemp(prefix="geoDL-bench-")
+    try:
+        data = fresh_dir(root, "data")
+        files = {}
+        for i in range(options.files):
+            name = "f{}.fq.gz".format(i)
+            path = os.path.join(data, name)
+            files[name] = (path,) + make_fastq(path, options.size, seed=i)
+        server = StandIn(files)
+        server.ftp_host = start_ftp(data)
+        if server.ftp_host is None and "download" in benchmarks:
+            print("pyftpdlib not installed: no FTP, the wget engine is not measured")
+        results = []
+        for benchmark in benchmarks:
+            run = globals()["bench_" + benchmark]
+            results.extend(run(server, root, options))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if options.compare:
+        with open(options.compare) as f:
+            if compare(results, json.load(f), options.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+from .geoDL import (
+    GeoDLError,
+    Plan,
+    Run,
+    Transfer,
+    __version__,
+    make_args,
+    plan,
+    resolve,
+)
@@ -10,18 +10,32 @@ import sys
 import os
 import re
 import argparse
-import csv
-import requests
-import bs4
-from bs4 import BeautifulSoup
-from subprocess import call
+import contextlib
+import email.utils
+import errno
+import ftplib
+import gc
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import logging
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from subprocess import Popen, call
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from colorama import Fore
-from six.moves.urllib.request import urlopen, urlretrieve
 
-if sys.version_info >= (3, 0):
-    from urllib.error import URLError
-else:
-    from urllib2 import URLError
+try:
+    import fcntl
+except ImportError:  # Windows: the NCBI rate limit is then per process
+    fcntl = None
 
 
 __version__ = "v1.0.b13"
@@ -38,6 +52,21 @@ logo = """
     __version__
 )
 
+# Endpoints, module level so that they can be pointed at local stand-ins
+GEO_URL = "https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={}"
+ENA_SEARCH_URL = (
+    "http://www.ebi.ac.uk/ena/data/warehouse/search?"
+    "query=%22geo_accession=%22{}%22%22&result=study&display=xml"
+)
+FILEREPORT_URL = (
+    "http://www.ebi.ac.uk/ena/data/warehouse/filereport?accession={}&result=read_run"
+    "&fields=study_accession,secondary_study_accession,sample_accession,"
+    "secondary_sample_accession,experiment_accession,run_accession,sample_alias,"
+    "scientific_name,instrument_model,library_layout,read_count,experiment_alias,"
+    "run_alias,fastq_ftp,fastq_bytes,fastq_md5&download=txt"
+)
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+
 
 class SmartFormatter(argparse.HelpFormatter):
     """Quick hack for formatting helper of argparse with new lines"""
@@ -49,13 +78,110 @@ class SmartFormatter(argparse.HelpFormatter):
         return argparse.HelpFormatter._split_lines(self, text, width)
 
 
+def parse_size(text):
+    """Parse a size like 1500, 20k, 500M or 1.5G into bytes"""
+    m = re.match(r"^\s*(\d+(?:\.\d*)?)\s*([kKmMgGtT]?)[bB]?\s*$", text)
+    if m is None:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(text))
+    power = " KMGT".index(m.group(2).upper() or " ")
+    return int(float(m.group(1)) * 1024 ** power)
+
+
+def parse_shard(text):
+    """Parse a shard like 2/8 into (2, 8)"""
+    m = re.match(r"^\s*(\d+)\s*/\s*(\d+)\s*$", text)
+    if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError("invalid shard: {} (eg: 1/4)".format(text))
+    return int(m.group(1)), int(m.group(2))
+
+
+def in_shard(args, name):
+    """Whether the sample `name` belongs to the --shard of this process. The
+    samples are spread by a hash of their name, the same on every node"""
+    if not args.shard:
+        return True
+    i, n = args.shard
+    return zlib.crc32(name.encode()) % n == i - 1
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} TB".format(size)
+
+
+class GeoDLError(Exception):
+    """What stops geoDL, with the message for the user"""
+
+
 def raiseError(errormsg):
-    print("\n" + Fore.RED + errormsg + Fore.RESET)
-    sys.exit(1)
+    raise GeoDLError(errormsg.strip())
+
+
+logger = logging.getLogger("geoDL")
+
 
+def echo(*parts):
+    """Tell the user, through the geoDL logger: the command line shows it on
+    stdout, a program using geoDL as a library decides"""
+    logger.info(" ".join(str(part) for part in parts))
 
-def get_args():
+
+def get_args(argv=None):
     """Parse and return all arguments"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        return check_args(args)
+    except GeoDLError as e:
+        parser.error(str(e))
+
+
+def make_args(mode, inputvalue, **options):
+    """The arguments of the command line `geoDL mode inputvalue`, with `options`
+    set by the name of their attribute, eg: jobs=4, max_reads=1000"""
+    args = build_parser().parse_args([mode, inputvalue])
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise TypeError("geoDL has no option {}".format(name))
+        setattr(args, name, value)
+    return check_args(args)
+
+
+def check_args(args):
+    """Fill the arguments derived from others and refuse incompatible ones"""
+    if args.engine is None:
+        args.engine = "ascp" if args.ascp else "wget"
+    args.ascp = args.engine == "ascp"
+    args.ascp_bin = shutil.which("ascp")
+    for option in ["jobs", "host_connections", "segments", "convert_jobs", "threads"]:
+        if getattr(args, option) < 1:
+            raiseError("--{} must be 1 or more".format(option.replace("_", "-")))
+    if args.merge and (args.max_reads or args.max_bytes):
+        raiseError("--merge cannot be used with --max-reads or --max-bytes")
+    if args.plan_format != "cmds" or args.plan_out:
+        if args.mode == "prefetch":
+            raiseError(
+                "--plan-format and --plan-out cannot be used in prefetch mode: "
+                "prefetch finds the files itself"
+            )
+        args.dry = True
+        if args.plan_format != "cmds" and (
+            args.merge or args.max_reads or args.max_bytes
+        ):
+            raiseError(
+                "--plan-format {} cannot be used with --merge, --max-reads or "
+                "--max-bytes: these files are written by geoDL".format(
+                    args.plan_format
+                )
+            )
+    return args
+
+
+def build_parser():
+    """The parser of the command line"""
     parser = argparse.ArgumentParser(
         description="""Download fastq from The European Nucleotide Archive (ENA)
                                      <http://www.ebi.ac.uk/ena> website using a GSE geo
@@ -65,11 +191,13 @@ def get_args():
         epilog="Made with <3 at the batcave",
     )
     parser.add_argument(
-        "mode", choices=["geo", "meta", "ena", "prefetch"], help="Which mode the program runs."
+        "mode",
+        choices=["geo", "meta", "ena", "prefetch", "batch"],
+        help="Which mode the program runs.",
     )
     parser.add_argument(
         "inputvalue",
-        metavar="GSE|metadata|ENA",
+        metavar="GSE|metadata|ENA|list",
         help="""R|geo:  GSE accession number, eg: GSE13373
       Map the GSE accession to the ENA study accession and fetch the metadata from ENA.
 
@@ -81,13 +209,44 @@ ena:  ENA study accession number, eg: PRJEB13373
       Fetch the metadata directely on the ENA website
 
 prefetch: Use NCBI prefetch (on NCBI server) to download the data, bypass the ENA website
-      entirely. This gives back SRA files - use NCBI tools for conversion. """,
+      entirely. This gives back SRA files - use NCBI tools for conversion.
+
+batch: File with one accession per line, or - for stdin. GSE accessions run in
+      geo mode, the others in ena mode; a line can also be "<mode> <input>"
+      with mode geo, ena or meta. The metadata of all the series are fetched
+      concurrently, then all the files go through one download queue, each
+      series in its own directory under --outdir. """,
     )
     parser.add_argument(
         "--ascp",
         action="store_true",
         help="Use Aspera for the download (requires an already configured aspera)",
     )
+    parser.add_argument(
+        "--engine",
+        choices=["wget", "ascp", "native", "auto"],
+        default=None,
+        help="R|Which program downloads the files (wget):\n"
+        "  wget:   one wget process per file\n"
+        "  ascp:   Aspera, same as --ascp\n"
+        "  native: built-in downloader, splitting each file in --segments\n"
+        "          byte ranges fetched in parallel\n"
+        "  auto:   time Aspera, HTTPS and FTP once on the first file, then\n"
+        "          get each file over the fastest, falling back to the\n"
+        "          next one when it fails",
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=4,
+        help="Number of parallel byte ranges per file for the native engine (4)",
+    )
+    parser.add_argument(
+        "--protocol",
+        choices=["https", "http", "ftp"],
+        default="https",
+        help="Protocol used by the native engine (https)",
+    )
     parser.add_argument(
         "--asperakey",
         type=str,
@@ -107,54 +266,657 @@ prefetch: Use NCBI prefetch (on NCBI server) to download the data, bypass the EN
         default="sample_alias",
         help="Name of the column to use in the metadata file to name the samples",
     )
+    parser.add_argument(
+        "--outdir",
+        "-o",
+        type=str,
+        default=".",
+        help="Directory where the metadata, the files and the logs are written (.)",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Samples with several runs get one file (per read) holding all their "
+        "runs, each run written in place as its own gzip member while it "
+        "downloads, instead of stopping on the non unique sample names",
+    )
     parser.add_argument(
         "--dry",
         action="store_true",
-        help="Don't actually download anything, just print the wget cmds",
+        help="Don't actually download anything, just print the wget cmds, or "
+        "write the plan in --plan-format",
+    )
+    parser.add_argument(
+        "--plan-format",
+        choices=PLAN_FORMATS,
+        default="cmds",
+        help="What --dry writes: the commands of geoDL (cmds), an aria2c input "
+        "file (aria2), an ascp --file-pair-list (ascp), or the url, file, size and "
+        "md5 of each file (json, tsv). Other than cmds, implies --dry and the urls "
+        "use --protocol",
+    )
+    parser.add_argument(
+        "--plan-out",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="Where --dry writes the plan, - for stdout (geoDL.plan.<format> in "
+        "--outdir, the screen for cmds)",
+    )
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="Don't check the md5 and gzip integrity of the downloaded files",
+    )
+    parser.add_argument(
+        "--count-reads",
+        action="store_true",
+        help="Also count the reads of each file and compare with ENA read_count",
+    )
+    parser.add_argument(
+        "--max-reads",
+        type=int,
+        default=None,
+        help="Only get the first N reads of each file, eg: for a pilot QC. The "
+        "start of the file is streamed, cut on a read boundary and recompressed; "
+        "R1 and R2 keep the same reads",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=parse_size,
+        default=None,
+        help="Only stream that much of each file, eg: 2G, keeping the complete "
+        "reads. Can be combined with --max-reads",
+    )
+    parser.add_argument(
+        "--convert",
+        action="store_true",
+        help="prefetch mode: convert each .sra to fastq.gz with fasterq-dump and "
+        "pigz as soon as it is downloaded",
+    )
+    parser.add_argument(
+        "--convert-jobs",
+        type=int,
+        default=2,
+        help="prefetch mode: number of conversions running at once (2)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="prefetch mode: threads of each fasterq-dump and pigz (4)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print a summary of the requests and transfers at the end, with "
+        "percentiles of their duration and throughput",
+    )
+    parser.add_argument(
+        "--stats-hook",
+        type=str,
+        default=None,
+        metavar="MODULE:FUNCTION",
+        help="Python function called with every event of geoDL.events.jsonl, "
+        "eg: to push the counters to a monitoring system",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "geoDL"
+        ),
+        help="Where the GEO/ENA/NCBI answers are cached (~/.cache/geoDL)",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=24,
+        help="Hours before a cached answer is fetched again (24)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=500,
+        help="Maximum size of the cache in MB, least recently used answers are "
+        "removed first (500). 0 disables the cache",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Shared store of the downloaded files, by run accession and md5: the "
+        "files found there are hard-linked into the output directory instead of "
+        "being downloaded, the new ones are added to it",
+    )
+    parser.add_argument(
+        "--store-size",
+        type=parse_size,
+        default=None,
+        help="Maximum size of the --store, eg: 2T. The least recently used files "
+        "are removed first (no limit)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        metavar="I/N",
+        help="Only download the I-th of N shares of the samples, eg: 2/4 on the "
+        "second of four nodes. The samples are split by a hash of their name",
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="SQLite file on a shared file system through which several geoDL "
+        "processes run with the same --outdir share the samples: each takes the "
+        "next one free, and the samples of a process that stopped are taken over. "
+        "Each process prints the report of all of them at the end",
+    )
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use cached answers, never go on the network for the metadata",
+    )
+    cache.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore the cached answers and fetch them again",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for a GEO/ENA/NCBI server before retrying (60)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Times a metadata request is retried on network errors, 429 and 5xx "
+        "answers, with exponential backoff (5)",
+    )
+    parser.add_argument(
+        "--api-key",
+        type=str,
+        default=os.environ.get("NCBI_API_KEY"),
+        help="NCBI API key, raising the E-utilities limit from 3 to 10 requests "
+        "per second ($NCBI_API_KEY)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of files (runs in prefetch mode) downloaded in parallel (1)",
+    )
+    parser.add_argument(
+        "--order",
+        choices=["largest", "smallest", "metadata"],
+        default="largest",
+        help="In which order the files are started (largest first, which ends "
+        "sooner when the sizes are known)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=parse_size,
+        default=None,
+        help="Cap on the total download rate, in bytes per second, eg: 500M",
+    )
+    parser.add_argument(
+        "--host-connections",
+        type=int,
+        default=4,
+        help="Maximum number of connections to the same host, counting each "
+        "--segments connection of a download (4)",
+    )
+    parser.set_defaults(progress=True)
+    return parser
+
+
+class EventLog(object):
+    """Machine readable log of the run, one json object per line appended to
+    geoDL.events.jsonl: every HTTP request and file transfer with its bytes,
+    duration, throughput, exit code and retries. The events are also kept for
+    the --stats summary and passed to the --stats-hook function"""
+
+    def __init__(self, path, hook=None):
+        self.path = path
+        self.hook = hook
+        self.run = "{}-{}".format(time.strftime("%Y%m%dT%H%M%S"), os.getpid())
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    @classmethod
+    def of(cls, args):
+        """The event log of this run, created on first use"""
+        if getattr(args, "events", None) is None:
+            hook = None
+            if getattr(args, "stats_hook", None):
+                module, _, function = args.stats_hook.partition(":")
+                try:
+                    hook = getattr(importlib.import_module(module), function)
+                except (ImportError, AttributeError) as e:
+                    raiseError(
+                        "  > ERROR: cannot load --stats-hook {}: {}".format(
+                            args.stats_hook, e
+                        )
+                    )
+            if not os.path.isdir(args.outdir):
+                os.makedirs(args.outdir)
+            args.events = cls(outpath(args, "geoDL.events.jsonl"), hook)
+        return args.events
+
+    def emit(self, kind, **fields):
+        event = dict(time=round(time.time(), 3), run_id=self.run, event=kind)
+        event.update(fields)
+        line = json.dumps(event, sort_keys=True)
+        with self.lock:
+            self.events.append(event)
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+        if self.hook is not None:
+            try:
+                self.hook(event)
+            except Exception as e:  # monitoring must not stop the downloads
+                echo(Fore.RED + "  > WARNING: --stats-hook failed: {}".format(e))
+                self.hook = None
+
+    def summary(self):
+        """Lines of the --stats report"""
+        wall = time.time() - self.start
+        lines = ["Run {} took {:.1f}s".format(self.run, wall)]
+        for kind in ["http", "transfer", "prefetch", "convert"]:
+            events = [e for e in self.events if e["event"] == kind]
+            if not events:
+                continue
+            failed = [e for e in events if e.get("exit", 0) != 0 or e.get("error")]
+            nbytes = sum(e.get("bytes") or 0 for e in events)
+            lines.append(
+                "{}: {} events, {} failed, {} retries, {} ({}/s overall)".format(
+                    kind,
+                    len(events),
+                    len(failed),
+                    sum(e.get("retries") or 0 for e in events),
+                    format_size(nbytes),
+                    format_size(nbytes / wall if wall else 0),
+                )
+            )
+            durations = [e["duration"] for e in events]
+            lines.append("  duration   " + percentiles(durations, "{:.2f}s"))
+            rates = [e["throughput"] for e in events if e.get("throughput")]
+            if rates and kind != "http":
+                lines.append("  throughput " + percentiles(rates, format_size, "/s"))
+                by_host = {}
+                for e in events:
+                    if e.get("throughput") and e.get("host"):
+                        by_host.setdefault(e["host"], []).append(e["throughput"])
+                for host, rates in sorted(by_host.items()):
+                    lines.append(
+                        "    {}: {} files, median {}/s".format(
+                            host, len(rates), format_size(quantile(rates, 0.5))
+                        )
+                    )
+        return lines
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def percentiles(values, fmt, unit=""):
+    fmt = fmt.format if isinstance(fmt, str) else fmt
+    return "  ".join(
+        "{} {}{}".format(name, fmt(quantile(values, q)), unit)
+        for name, q in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1)]
+    )
+
+
+class RateLimiter(object):
+    """Space the calls to `wait` by 1/`rate` seconds. With a `path`, the next free
+    slot is kept in that file under a lock, so that all the geoDL processes of
+    the machine share the limit"""
+
+    def __init__(self, rate, path=None):
+        self.interval = 1.0 / rate
+        self.path = path
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            if self.path is None or fcntl is None:
+                slot = max(self.next_slot, now)
+                self.next_slot = slot + self.interval
+            else:
+                with open(self.path, "a+") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    f.seek(0)
+                    try:
+                        slot = max(float(f.read() or 0), now)
+                    except ValueError:
+                        slot = now
+                    f.seek(0)
+                    f.truncate()
+                    f.write(repr(slot + self.interval))
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class HttpClient(object):
+    """The pooled session of the metadata requests. Network errors, 429 and 5xx
+    answers are retried up to `retries` times, after an exponential backoff with
+    full jitter or the Retry-After of the server when it is longer. Requests to
+    the E-utilities carry the NCBI `api_key` and are held under their rate limit:
+    3 per second, 10 with a key"""
+
+    retry_status = (429, 500, 502, 503, 504)
+    backoff_base = 1.0
+    backoff_max = 60.0
+
+    def __init__(self, timeout=60, retries=5, api_key=None, lock_dir=None):
+        import requests
+
+        self.timeout = timeout
+        self.retries = retries
+        self.api_key = api_key
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=16)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        lock = None
+        if lock_dir is not None and os.path.isdir(lock_dir):
+            lock = os.path.join(lock_dir, ".eutils-{}".format(10 if api_key else 3))
+        self.ncbi = RateLimiter(10 if api_key else 3, lock)
+
+    @classmethod
+    def from_args(cls, args):
+        if not os.path.isdir(args.cache_dir):
+            try:
+                os.makedirs(args.cache_dir)
+            except OSError:  # the rate limit is then per process
+                pass
+        return cls(args.timeout, args.retries, args.api_key, args.cache_dir)
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before the retry number `attempt` + 1"""
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        wait = random.uniform(0, ceiling)
+        if retry_after:
+            try:
+                asked = float(retry_after)
+            except ValueError:  # an HTTP date
+                try:
+                    date = email.utils.parsedate_tz(retry_after)
+                    asked = email.utils.mktime_tz(date) - time.time()
+                except (TypeError, ValueError, OverflowError):
+                    asked = 0
+            wait = max(wait, min(asked, 10 * self.backoff_max))
+        return wait
+
+    def download(self, f, url, params=None, data=None):
+        """Write the answer at `url` in the binary file `f`, POSTing `data` when
+        given. Return the HTTP status and the number of retries. The last error
+        is raised with its number of retries in `e.retries`"""
+        import requests
+
+        if url.startswith(EUTILS_URL) and self.api_key:
+            if data is not None:
+                data = dict(data, api_key=self.api_key)
+            else:
+                params = dict(params or {}, api_key=self.api_key)
+        attempt = 0
+        while True:
+            if url.startswith(EUTILS_URL):
+                self.ncbi.wait()
+            retry_after = None
+            try:
+                if data is not None:
+                    r = self.session.post(
+                        url, data=data, stream=True, timeout=self.timeout
+                    )
+                else:
+                    r = self.session.get(
+                        url, params=params, stream=True, timeout=self.timeout
+                    )
+                with r:
+                    last = attempt >= self.retries
+                    if r.status_code not in self.retry_status or last:
+                        r.raise_for_status()
+                        f.seek(0)
+                        f.truncate()
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                        return r.status_code, attempt
+                    retry_after = r.headers.get("Retry-After")
+                    reason = "HTTP {}".format(r.status_code)
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                if attempt >= self.retries:
+                    e.retries = attempt
+                    raise
+                reason = e.__class__.__name__
+            except requests.RequestException as e:
+                e.retries = attempt
+                raise
+            wait = self.backoff(attempt, retry_after)
+            attempt += 1
+            echo(
+                Fore.YELLOW
+                + "  > {} for {}, retry {}/{} in {:.1f}s".format(
+                    reason, url, attempt, self.retries, wait
+                )
+                + Fore.RESET
+            )
+            time.sleep(wait)
+
+
+class MetaCache(object):
+    """On-disk cache of the metadata pages, one file per url and parameters.
+    Answers older than `ttl` seconds are fetched again, unless offline. Reading
+    an answer refreshes its mtime, so that the least recently used ones are
+    removed first when the cache grows past `max_size` bytes. The pages missing
+    are fetched with one HttpClient, shared by all threads and made by
+    `new_client` on the first miss"""
+
+    def __init__(
+        self, path, ttl, max_size, offline=False, refresh=False, client=None
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.events = None
+        self.client = client
+        self.new_client = HttpClient
+
+    @classmethod
+    def from_args(cls, args):
+        cache = cls(
+            args.cache_dir,
+            args.cache_ttl * 3600,
+            int(args.cache_size * 1024 ** 2),
+            args.offline,
+            args.refresh,
+        )
+        cache.new_client = lambda: HttpClient.from_args(args)
+        cache.events = EventLog.of(args)
+        return cache
+
+    def http(self):
+        """The HttpClient, made on the first page missing from the cache"""
+        with self.lock:
+            if self.client is None:
+                self.client = self.new_client()
+            return self.client
+
+    def key(self, url, params=None):
+        """File name of an answer: the endpoint, then a hash of the full query"""
+        query = url + "?" + "&".join(
+            "{}={}".format(k, v) for k, v in sorted((params or {}).items())
+        )
+        endpoint = re.sub(r"\W+", "_", url.split("?")[0].rstrip("/").split("/")[-1])
+        return "{}-{}".format(endpoint, hashlib.sha1(query.encode()).hexdigest())
+
+    def has(self, key):
+        """Whether the answer `key` can be read from the cache"""
+        if self.max_size <= 0 or (self.refresh and not self.offline):
+            return False
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(self.path, key))
+        except OSError:
+            return False
+        return age <= self.ttl or self.offline
+
+    def evict(self):
+        """Remove the least recently used answers until the cache fits"""
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if name.startswith("."):  # being written
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                total -= size
+
+    def open(self, url, params=None, data=None, key=None, fresh=False):
+        """Return the answer at `url` as a binary file, from the cache when
+        possible. The answer is POSTed when there is `data`, and streamed to disk
+        rather than kept in memory. `key` replaces the default cache key, `fresh`
+        skips the cached answer"""
+        if key is None:
+            key = self.key(url, dict(params or {}, **(data or {})))
+        path = os.path.join(self.path, key)
+        start = time.time()
+        if not fresh and self.has(key):
+            os.utime(path, None)
+            try:
+                f = open(path, "rb")
+            except (IOError, OSError):  # evicted by another process
+                pass
+            else:
+                size = os.fstat(f.fileno()).st_size
+                self.emit(url, start, size, cached=True, retries=0)
+                return f
+        if self.offline:
+            raiseError(
+                " > ERROR: {} is not in the cache ({}) and --offline is set".format(
+                    url, self.path
+                )
+            )
+        import requests
+
+        client = self.http()
+        if self.max_size > 0:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            tmp = os.path.join(self.path, ".{}.{}".format(key, os.getpid()))
+            f = open(tmp, "w+b")
+        else:
+            f = tempfile.TemporaryFile()
+        try:
+            status, retries = client.download(f, url, params, data)
+        except requests.RequestException as e:
+            f.close()
+            if self.max_size > 0:
+                os.remove(tmp)
+            response = getattr(e, "response", None)
+            self.emit(
+                url,
+                start,
+                0,
+                status=getattr(response, "status_code", None),
+                retries=getattr(e, "retries", 0),
+                error=str(e),
+            )
+            raiseError(" > ERROR: Could not get {}: {}".format(url, e))
+        self.emit(url, start, f.tell(), status=status, retries=retries)
+        f.flush()
+        f.seek(0)
+        if self.max_size > 0:
+            os.rename(tmp, path)
+            self.evict()
+        return f
+
+    def emit(self, url, start, nbytes, **fields):
+        if self.events is not None:
+            duration = time.time() - start
+            self.events.emit(
+                "http",
+                url=url,
+                bytes=nbytes,
+                duration=round(duration, 3),
+                throughput=round(nbytes / duration, 1) if duration else None,
+                **fields
+            )
+
+    def fetch(self, url, params=None, fresh=False):
+        """Return the text at `url`, from the cache when possible"""
+        with self.open(url, params, fresh=fresh) as f:
+            return f.read().decode("utf-8", "replace")
+
+
+def log_header(args):
+    """First line of the run in geoDL.logs, which keeps the previous runs"""
+    return "\n# {} {} {} download log \n".format(
+        time.strftime("%Y-%m-%d %H:%M:%S"), args.mode, args.inputvalue
     )
-    return parser.parse_args()
 
 
-def get_metadata(args):
+def outpath(args, name):
+    """Path of `name` in the output directory"""
+    return os.path.normpath(os.path.join(args.outdir, name))
+
+
+def get_metadata(args, cache=None):
     """Get the metadata. If geo mode, search on ENA website, if ENA, directely take
     from the ENA website. Also return the mapping between GEO and ENA naming"""
+    map_dict = {}
+    if cache is None:
+        cache = MetaCache.from_args(args)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
     if args.mode == "geo":
-        print("Getting correspondance table from GEO...")
-        geo_url = "http://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={}".format(
-            args.inputvalue
-        )
-        try:
-            geo_soup = BeautifulSoup(urlopen(geo_url).read(), "html.parser")
-        except URLError:
-            raiseError(" > ERROR: Could not reach GEO website... exiting!")
-        geo_table_soup = geo_soup.find(text=re.compile("Samples \(\d+\)")).findNext(
-            "td"
-        )
+        from bs4 import BeautifulSoup, FeatureNotFound
 
-        map_dict = {}
-        all_trs = geo_table_soup.find_all("tr")
-        print(
+        echo("Getting correspondance table from GEO...")
+        map_dict = geo_titles(args, cache) or geo_titles_html(args, cache)
+        echo(
             Fore.GREEN
-            + " > Found {} samples on GEO page...".format(len(all_trs))
+            + " > Found {} samples on GEO page...".format(len(map_dict))
             + Fore.RESET
         )
-        for tr in all_trs:
-            tds = tr.find_all("td")
-            map_dict[tds[0].text] = tds[1].text
 
-        print("\nLooking for the metadata on ENA website...")
-        search_url = "http://www.ebi.ac.uk/ena/data/warehouse/search?query=%22geo_accession=%22{geo}%22%22&result=study&display=xml".format(
-            geo=args.inputvalue
-        )
-        print(search_url)
+        echo("\nLooking for the metadata on ENA website...")
+        search_url = ENA_SEARCH_URL.format(args.inputvalue)
+        echo(search_url)
         try:
-            print(" > Visiting ENA website...")
-            search_soup = BeautifulSoup(urlopen(search_url).read(), "lxml")
-        except URLError:
-            raiseError(
-                " > ERROR: Page not found error at {} ... exiting!".format(search_url)
-            )
-        except bs4.FeatureNotFound:
+            echo(" > Visiting ENA website...")
+            search_soup = BeautifulSoup(cache.fetch(search_url), "lxml")
+        except FeatureNotFound:
             raiseError(
                 " > ERROR: Module lxml not found. pip install --user lxml".format(
                     search_url
@@ -170,261 +932,2725 @@ def get_metadata(args):
             )
 
         ena_access = search_results[0].contents[0]
-        metafile = "metadata_{}.xls".format(args.inputvalue)
-        urlretrieve(
-            "http://www.ebi.ac.uk/ena/data/warehouse/filereport?accession={}&result=read_run&fields=study_accession,secondary_study_accession,sample_accession,secondary_sample_accession,experiment_accession,run_accession,sample_alias,scientific_name,instrument_model,library_layout,read_count,experiment_alias,run_alias,fastq_ftp&download=txt".format(
-                ena_access
-            ),
-            metafile,
-        )
-        print(Fore.GREEN + " > Metafile retrieved {}!".format(metafile) + Fore.RESET)
+        metafile = outpath(args, "metadata_{}.xls".format(args.inputvalue))
+        with open(metafile, "w") as meta:
+            meta.write(cache.fetch(FILEREPORT_URL.format(ena_access)))
+        echo(Fore.GREEN + " > Metafile retrieved {}!".format(metafile) + Fore.RESET)
 
     elif args.mode == "ena":
-        metafile = "metadata_{}.xls".format(args.inputvalue)
-        urlretrieve(
-            "http://www.ebi.ac.uk/ena/data/warehouse/filereport?accession={}&result=read_run&fields=study_accession,secondary_study_accession,sample_accession,secondary_sample_accession,experiment_accession,run_accession,sample_alias,scientific_name,instrument_model,library_layout,read_count,experiment_alias,run_alias,fastq_ftp&download=txt".format(
-                args.inputvalue
-            ),
-            metafile,
-        )
-        print(
+        metafile = outpath(args, "metadata_{}.xls".format(args.inputvalue))
+        with open(metafile, "w") as meta:
+            meta.write(cache.fetch(FILEREPORT_URL.format(args.inputvalue)))
+        echo(
             Fore.GREEN
             + " > Metafile retrieved from ENA {}!".format(metafile)
             + Fore.RESET
         )
     elif args.mode == "meta":
-        print(
+        echo(
             "\nUsing the {} metadata file ony (bypass GEO)...".format(args.inputvalue)
         )
         metafile = args.inputvalue
 
     elif args.mode == "prefetch":
-        print("Prefetch mode: getting the SRR list...")
-        metafile = "metadata_{}.xls".format(args.inputvalue)
-        r = requests.get(
-            "https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={gse}".format(
-                gse=args.inputvalue
+        echo("Prefetch mode: getting the SRR list...")
+        metafile = outpath(args, "metadata_{}.xls".format(args.inputvalue))
+        try:
+            project = geo_series(cache, args.inputvalue)[2]
+        except GeoDLError:  # the HTML page then
+            project = ""
+        if not project:
+            from bs4 import BeautifulSoup
+
+            geosoup = BeautifulSoup(
+                cache.fetch(GEO_URL.format(args.inputvalue)), "html.parser"
+            )
+            links = [url for url in geosoup.find_all("a") if "PRJ" in url.get_text()]
+            project = links[0].get_text()
+        map_dict = sra_runinfo(args, cache, project, metafile)
+    return metafile, map_dict
+
+
+GEO_SOFT = {"form": "text", "view": "brief"}
+
+
+def soft_lines(f):
+    """Yield the (key, value) of the lines of a binary SOFT file as they are read,
+    eg: ("^SAMPLE", "GSM1234"), ("!Sample_title", "WT rep1")"""
+    for line in io.TextIOWrapper(f, encoding="utf-8", errors="replace"):
+        key, sep, value = line.partition(" = ")
+        if sep:
+            yield key.strip(), value.strip()
+
+
+def geo_series(cache, accession):
+    """The samples, SubSeries and BioProject of a GEO series, from its brief SOFT
+    record"""
+    samples, subseries, project = [], [], ""
+    with cache.open(GEO_URL.format(accession), dict(GEO_SOFT, targ="self")) as f:
+        for key, value in soft_lines(f):
+            if key == "!Series_sample_id":
+                samples.append(value)
+            elif key == "!Series_relation" and value.startswith("SuperSeries of:"):
+                subseries.append(value.split(":", 1)[1].strip())
+            elif key == "!Series_relation" and value.startswith("BioProject:"):
+                project = value.rstrip("/").rsplit("/", 1)[-1]
+    return samples, subseries, project
+
+
+def geo_samples(cache, accession):
+    """Map the GSM of a GEO series to their title, from the brief SOFT records of
+    its samples. Unlike the HTML page, the list is never truncated"""
+    titles = {}
+    gsm = None
+    with cache.open(GEO_URL.format(accession), dict(GEO_SOFT, targ="gsm")) as f:
+        for key, value in soft_lines(f):
+            if key == "^SAMPLE":
+                gsm = value
+            elif key == "!Sample_title" and gsm is not None:
+                titles[gsm] = value
+                gsm = None
+    return titles
+
+
+def geo_titles(args, cache):
+    """Map the GSM of the series to their title from the SOFT export of GEO, the
+    SubSeries of a SuperSeries fetched concurrently. Empty when GEO did not
+    answer"""
+    try:
+        samples, subseries, _ = geo_series(cache, args.inputvalue)
+        series = [args.inputvalue] + subseries
+        with ThreadPoolExecutor(max_workers=min(len(series), 8)) as pool:
+            parts = list(pool.map(lambda acc: geo_samples(cache, acc), series))
+    except GeoDLError as e:
+        echo(Fore.RED + "{}, reading the HTML page".format(e) + Fore.RESET)
+        return {}
+    map_dict = {}
+    for part in parts:
+        map_dict.update(part)
+    missing = len(set(samples) - set(map_dict))
+    if missing:
+        echo(
+            Fore.RED
+            + " > {} samples of {} have no SOFT record".format(
+                missing, args.inputvalue
             )
+            + Fore.RESET
         )
-        geosoup = BeautifulSoup(r.text, "html.parser")
-        projurl = [url for url in geosoup.find_all("a") if "PRJ" in url.get_text()][0]
-        payload = {"db": "SRA",
-                   "term": "{}".format(projurl.get_text()),
-                   "retmax": 10000}
-        r = requests.get(
-            "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi", params=payload
+    return map_dict
+
+
+def geo_titles_html(args, cache):
+    """Map the GSM of the series to their title from the samples table of its HTML
+    page, which GEO truncates for big series"""
+    from bs4 import BeautifulSoup
+
+    geo_url = GEO_URL.format(args.inputvalue)
+    geo_soup = BeautifulSoup(cache.fetch(geo_url), "html.parser")
+    geo_table_soup = geo_soup.find(text=re.compile("Samples \(\d+\)")).findNext("td")
+    map_dict = {}
+    for tr in geo_table_soup.find_all("tr"):
+        tds = tr.find_all("td")
+        map_dict[tds[0].text] = tds[1].text
+    return map_dict
+
+
+EFETCH_CHUNK = 500
+
+
+def esearch_history(cache, term, fresh=False):
+    """Put the SRA search `term` on the NCBI history server, return the number of
+    ids, the WebEnv and the query key"""
+    from lxml import etree
+
+    payload = {"db": "SRA", "term": term, "usehistory": "y", "retmax": 0}
+    root = etree.fromstring(
+        cache.fetch(EUTILS_URL + "esearch.fcgi", payload, fresh).encode("utf-8")
+    )
+    if root.find("WebEnv") is None:
+        raiseError(" > ERROR: esearch of {} returned no WebEnv".format(term))
+    return (
+        int(root.findtext("Count")),
+        root.findtext("WebEnv"),
+        root.findtext("QueryKey"),
+    )
+
+
+def sra_runinfo(args, cache, term, metafile):
+    """Write in `metafile` one line per RUN of the SRA search `term` and return the
+    mapping between run accession and sample name.
+
+    The ids stay on the NCBI history server and are efetched by chunks of
+    EFETCH_CHUNK experiments, POSTed a few at a time. Each answer is streamed to
+    disk and parsed incrementally, so memory does not grow with the project."""
+    from lxml import etree
+
+    def chunk_key(start):
+        return cache.key(
+            EUTILS_URL + "efetch.fcgi",
+            {"term": term, "retstart": start, "retmax": EFETCH_CHUNK},
         )
-        esearchsoup = BeautifulSoup(r.text, "lxml")
-        ids = [i.get_text() for i in esearchsoup.idlist.find_all("id")]
-        print(Fore.GREEN + "> Found {} entries...".format(len(ids)) + Fore.RESET)
-        payload = {"db": "SRA",
-                   "id": ','.join(ids)}
-        r = requests.get("https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi",
-                params=payload)
-        efetchsoup = BeautifulSoup(r.text, "lxml")
-        exps = efetchsoup.find_all("run_set")
-        assert len(exps) == len(ids)
-        runs = efetchsoup.find_all("run")
-        map_dict = {}
-        n_rep = len(set([run["alias"].split("_")[1] for run in runs]))
-        with open(metafile, "w") as meta:
-            for i, run in enumerate(runs):
-                name = run.pool.member["sample_title"]
-                if n_rep > 1:
-                    suffix = run["alias"].split("_")[1]  # e.g. GSM20202020_r2
-                    rename = "_".join([re.sub(r"\s+", "_", name), suffix])
-                else:
-                    rename = "_".join(re.sub(r"\s+", "_", name))
-                map_dict[run["accession"]] = rename
-                if i == 0:
-                    header = "\t".join(list(run.attrs.keys()) + \
-                                       list(run.pool.member.attrs.keys()) + \
-                                       ["paired", "rename"]) + \
-                                       "\n"
-                    meta.write(header)
-                paired = "SE" if len(run.statistics.find_all("read")) == 1 else "PE"
-                data = "\t".join(list(run.attrs.values()) + \
-                                 list(run.pool.member.attrs.values()) + \
-                                 [paired, rename]) + \
-                                 "\n"
-                meta.write(data)
-    return metafile, map_dict
 
+    count, webenv, query_key = esearch_history(cache, term)
+    starts = range(0, count, EFETCH_CHUNK)
+    if not all(cache.has(chunk_key(start)) for start in starts):
+        # the cached WebEnv may have expired on the history server
+        count, webenv, query_key = esearch_history(cache, term, fresh=not cache.offline)
+        starts = range(0, count, EFETCH_CHUNK)
+    echo(Fore.GREEN + "> Found {} entries...".format(count) + Fore.RESET)
 
-def ena_dl(args, metafile, map_dict):
-    """Download the data from ENA using wget or ascp, using the metadta the metadata
-    """
+    def fetch_chunk(start):
+        """Parse a chunk into a temporary file of json runs, return the file, the
+        number of experiments and the replicate suffixes seen"""
+        payload = {
+            "db": "SRA",
+            "WebEnv": webenv,
+            "query_key": query_key,
+            "retstart": start,
+            "retmax": EFETCH_CHUNK,
+        }
+        out = tempfile.TemporaryFile(mode="w+", dir=args.outdir)
+        n_exp, suffixes = 0, set()
+        with cache.open(
+            EUTILS_URL + "efetch.fcgi", data=payload, key=chunk_key(start)
+        ) as f:
+            for _, package in etree.iterparse(f, tag="EXPERIMENT_PACKAGE"):
+                n_exp += 1
+                for run in package.iter("RUN"):
+                    member = run.find("Pool/Member")
+                    member = {} if member is None else dict(member.attrib)
+                    alias = run.get("alias", "")
+                    suffix = alias.split("_")[1] if "_" in alias else ""
+                    suffixes.add(suffix)
+                    reads = run.findall("Statistics/Read")
+                    record = {
+                        "run": list(run.attrib.items()),
+                        "member": list(member.items()),
+                        "paired": "SE" if len(reads) == 1 else "PE",
+                        "suffix": suffix,
+                    }
+                    out.write(json.dumps(record) + "\n")
+                package.clear()
+                while package.getprevious() is not None:
+                    del package.getparent()[0]
+        out.seek(0)
+        return out, n_exp, suffixes
 
-    # check that the column selected for naming is uniq
-    with open(metafile) as f:
-        reader = csv.reader(f, delimiter="\t")
-        samplenames = []
-        for i, row in enumerate(reader):
-            if i == 0:
-                if args.colname not in row:
-                    raiseError(
-                        "  > ERROR: Column {col} not in the metadata file "
-                        "{meta}".format(col=args.colname, meta=metafile)
-                    )
-                for j, c in enumerate(row):
-                    if c == args.colname:
-                        idx = j
-            else:
-                if row[idx] in samplenames:
-                    raiseError(
-                        "  > ERROR: Non uniq sample names in the column {col} "
-                        "of the meta file {meta}\n".format(
-                            col=args.colname, meta=metafile
-                        )
-                    )
-                samplenames.append(row[idx])
-    return metafile, map_dict
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        chunks = list(pool.map(fetch_chunk, starts))
+    n_exp = sum(n for _, n, _ in chunks)
+    if n_exp != count:
+        raiseError(
+            " > ERROR: got {} experiments from efetch, expected {}".format(n_exp, count)
+        )
+    n_rep = len(set.union(set(), *[suffixes for _, _, suffixes in chunks]))
 
-    dlsoft = "aspera" if args.ascp else "wget"
-    print("Starting the downloads with {}\n".format(dlsoft))
-    with open(metafile) as f, open("geoDL.logs", "w") as log:
-        for i, line in enumerate(f):
-            if i == 0:
-                header = [h.strip() for h in line.split("\t")]
-                log.write("{} download log \n".format(args.inputvalue))
-                continue
-            data = dict(zip(header, [sp.strip() for sp in line.split("\t")]))
-            try:
-                data_urls = data["fastq_ftp"].split(";")
-            except KeyError:
-                raiseError(
-                    "  > ERROR: Fastq urls (ftp) is not in the metadata, \
-                           make sure to add the column and try again."
-                )
-            if args.mode == "geo":
-                m = re.search("(GSM\d+)", data[args.colname])
-                if m is None:
-                    raiseError("  > ERROR: Regexp did not match...")
-                if len(m.groups()) > 1:
-                    raiseError("  > ERROR: Regexp matched multiple times...")
-                gsm = m.group(1)
-                try:
-                    outname = map_dict[gsm].replace(" ", "_")
-                except KeyError:
-                    raiseError(
-                        "  > ERROR: The GSM {} was not found in the GEO page...  exiting!".format(
-                            gsm
+    map_dict = {}
+    header = None
+    with open(metafile, "w") as meta:
+        for out, _, _ in chunks:
+            with out:
+                for line in out:
+                    record = json.loads(line)
+                    run, member = dict(record["run"]), dict(record["member"])
+                    if header is None:
+                        header = [k for k, _ in record["run"]], [
+                            k for k, _ in record["member"]
+                        ]
+                        meta.write(
+                            "\t".join(header[0] + header[1] + ["paired", "rename"])
+                            + "\n"
                         )
+                    rename = re.sub(r"\s+", "_", member.get("sample_title", ""))
+                    if n_rep > 1:  # e.g. GSM20202020_r2
+                        rename = "_".join([rename, record["suffix"]])
+                    map_dict[run["accession"]] = rename
+                    values = [run.get(k, "") for k in header[0]] + [
+                        member.get(k, "") for k in header[1]
+                    ]
+                    meta.write(
+                        "\t".join(
+                            [re.sub(r"[\t\n]", " ", v) for v in values]
+                            + [record["paired"], rename]
+                        )
+                        + "\n"
                     )
-                if len(args.samples) > 0 and gsm not in args.samples:
-                    continue
-                log.write(gsm + " --> " + outname + "\n")
-            else:
-                outname = data[args.colname].replace(" ", "_")
-            if len(data_urls) == 2:  # paired end
-                suffix = ["_R1", "_R2"]
-                pair = True
-            elif len(data_urls) == 1:  # single end
-                suffix = [""]
-                pair = False
-            else:
-                raiseError(" > ERROR: number of urls in fastq url column is unexpected")
-            for r, url in enumerate(data_urls):
-                if pair:
-                    print(
-                        Fore.GREEN
-                        + "\n > Getting {}{}...\n".format(outname, suffix[r])
-                        + 80 * "="
-                        + Fore.RESET
-                    )
-                else:
-                    print(
-                        Fore.GREEN
-                        + "\n > Getting {}...\n".format(outname, suffix[r])
-                        + 80 * "="
-                        + Fore.RESET
-                    )
-                wgetcmd = [
-                    "wget",
-                    "--no-use-server-timestamps",
-                    "-nH",
-                    "ftp://" + url,
-                    "-O",
-                    outname + suffix[r] + ".fq.gz",
-                ]
+    return map_dict
 
-                ascp = os.popen("which ascp").read().strip()
-                ascpcmd = [
-                    ascp,
-                    "-T",
-                    "--policy",
-                    "high",
-                    "-l",
-                    "10G",
-                    "-i",
-                    args.asperakey,
-                    "-P",
-                    "33001",
-                    url.replace("ftp.sra.ebi.ac.uk", "era-fasp@fasp.sra.ebi.ac.uk:"),
-                    outname + suffix[r] + ".fq.gz",
-                ]
-                if args.dry:
-                    if args.ascp:
-                        print(" ".join(ascpcmd))
-                    else:
-                        print(" ".join(wgetcmd))
-                else:
-                    if args.ascp:
-                        try:
-                            ret = call(ascpcmd)
-                            if ret != 0:
-                                print("  > ERROR: ascp returned {}".format(ret))
-                                print("  > cmd was: \n{}".format(" ".join(ascpcmd)))
-                                sys.exit(1)
-                        except FileNotFoundError:
-                            raiseError(
-                                "  > ERROR: ascp not found, please install and try again !"
-                            )
-                        log.write(" ".join(ascpcmd) + "\n")
-                    else:
-                        try:
-                            ret = call(wgetcmd)
-                            if ret != 0:
-                                print("  > ERROR: wget returned {}".format(ret))
-                                print("  > cmd was: \n{}".format(" ".join(wgetcmd)))
-                        except FileNotFoundError:
-                            raiseError(
-                                "  > ERROR: wget not found, please install and try again !"
-                            )
-                            sys.exit(1)
-                        log.write(" ".join(wgetcmd) + "\n")
 
+class MetaTable(object):
+    """The metadata file loaded in a single pass: one tuple of values per run,
+    plus hash indexes of the runs by GSM, run accession and sample name"""
 
-def prefetch_dl(args, metafile, map_dict):
-    """Use the NCBI prefetch program to download the data"""
-    assert len(set(map_dict.values())) == len(map_dict.keys()), "Non unique sample name"
-    with open(metafile) as meta, open("geoDL.logs", "w") as log:
-        for n, sample in enumerate(meta):
-            sp = sample.strip().split("\t")
-            if n == 0:  # header
-                continue
-            srr = sp[1]
-            if args.ascp:
-                ascp = os.popen("which ascp").read().strip()
-                cmd = ["prefetch", "-v", "-X", "100GB", "-t", "ascp",
-                       "-a", ascp+"|"+args.asperakey, srr]
-            else:
-                cmd = ["prefetch", "-v", "-X", "100GB", srr]
-            log.write(" ".join(cmd) + "\n")
-            call(cmd)
-            call(["touch", srr])
-            call(["mv", srr, map_dict[srr]+".sra"])
+    gsm_regexp = re.compile(r"(GSM\d+)")
+
+    def __init__(self, path, colname):
+        self.path = path
+        self.rows = []
+        self.gsms = []  # GSM found in the naming column, or ""
+        self.runs = []  # run accession, or ""
+        self.by_gsm = {}
+        self.by_run = {}
+        self.by_name = {}
+        with open(path) as f:
+            self.header = [h.strip() for h in f.readline().split("\t")]
+            self.columns = {}
+            for j, column in enumerate(self.header):
+                self.columns.setdefault(column, j)
+            run_col = self.columns.get("run_accession", self.columns.get("accession"))
+            name_col = self.columns.get(colname)
+            collect = gc.isenabled()
+            gc.disable()  # only new objects: the collector would rescan them all
+            try:
+                self._load(f, run_col, name_col)
+            finally:
+                if collect:
+                    gc.enable()
+
+    def _load(self, f, run_col, name_col):
+        for line in f:
+            if not line.strip():
+                continue
+            row = tuple(map(str.strip, line.split("\t")))
+            i = len(self.rows)
+            self.rows.append(row)
+            run = row[run_col] if run_col is not None and run_col < len(row) else ""
+            self.runs.append(run)
+            if run:
+                self.by_run[run] = i
+            gsm = ""
+            if name_col is not None and name_col < len(row):
+                name = row[name_col]
+                self.by_name.setdefault(name, []).append(i)
+                m = self.gsm_regexp.search(name)
+                if m is not None:
+                    gsm = m.group(1)
+                    self.by_gsm.setdefault(gsm, []).append(i)
+            self.gsms.append(gsm)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, i, column, default=""):
+        """Value of `column` for the run `i`"""
+        j = self.columns.get(column)
+        if j is None or j >= len(self.rows[i]):
+            return default
+        return self.rows[i][j]
+
+    def duplicates(self):
+        """Values of the naming column shared by several runs"""
+        return [name for name, rows in self.by_name.items() if len(rows) > 1]
+
+    def select(self, samples):
+        """Indexes of the runs matching any of the GSM, run accessions or sample
+        names in `samples`, in the order of the file. All the runs if no sample"""
+        if not samples:
+            return range(len(self.rows))
+        selected = set()
+        for sample in samples:
+            selected.update(self.by_gsm.get(sample, ()))
+            selected.update(self.by_name.get(sample, ()))
+            if sample in self.by_run:
+                selected.add(self.by_run[sample])
+        return sorted(selected)
+
+
+class Transfer(object):
+    """One fastq file to fetch, with the command doing it. The command is None
+    when the native engine is used, `transport` is then its protocol"""
+
+    __slots__ = (
+        "name", "url", "outfile", "host", "cmd", "run", "size", "md5", "reads",
+        "status", "series", "nbytes", "transport", "retries", "mate", "sample",
+        "sampled", "offset", "group",
+    )
+
+    def __init__(self, name, url, outfile, run="", size=None, md5="", reads=None):
+        self.name = name
+        self.url = url
+        self.outfile = outfile
+        self.host = url.split("/")[0]
+        self.cmd = None
+        self.run = run
+        self.size = size
+        self.md5 = md5
+        self.reads = reads
+        self.status = ""
+        self.series = ""
+        self.nbytes = 0  # downloaded by this run
+        self.transport = None
+        self.retries = 0  # transports given up for this file
+        self.mate = None  # the other file of a paired-end run
+        self.sample = ""  # limits of a sampled download, eg: max_reads=1000
+        self.sampled = None  # reads written by a sampled download
+        self.offset = None  # where the file starts in a merged output
+        self.group = None  # the transfers of a merged output, in order
+
+    @property
+    def record(self):
+        """Run accession of the file in the manifest, tagged for samples, all the
+        runs for merged outputs"""
+        if self.group is not None:
+            return "+".join(t.run for t in self.group)
+        return self.run + ("#" + self.sample if self.sample else "")
+
+    def describe(self, args):
+        if self.cmd is not None:
+            return " ".join(self.cmd)
+        return "GET {}://{} -O {}{}{}".format(
+            self.transport or args.protocol,
+            self.url,
+            self.outfile,
+            " ({})".format(self.sample) if self.sample else "",
+            " (at byte {})".format(self.offset) if self.offset is not None else "",
+        )
+
+
+def ena_dl(args, table, map_dict):
+    """Download the data from ENA using wget, ascp or the native engine, using the
+    metadata. Exit with an error once they are all over if some failed"""
+    with open(outpath(args, "geoDL.logs"), "a") as log:
+        log.write(log_header(args))
+        transfers = plan_downloads(args, table, map_dict, log)
+        if args.dry:
+            write_plan(args, transfers)
+            return
+        skipped, failed = download(args, transfers, log)
+    if failed:
+        raiseError("  > ERROR: Some downloads failed, see geoDL.logs")
+
+
+def plan_downloads(args, table, map_dict, log):
+    """Check the metadata and return the list of Transfer to do, in the order of
+    the metadata file"""
+    return plan_runs(args, table_runs(args, table, map_dict, log))
+
+
+class Run(object):
+    """One run of the metadata, named after its sample, with its fastq files.
+    `fields` has all the columns of the metadata file"""
+
+    __slots__ = (
+        "run", "sample", "gsm", "urls", "sizes", "md5s", "reads", "series", "fields",
+    )
+
+    def __init__(self, run, sample, urls, sizes=(), md5s=(), reads=None, gsm=""):
+        self.run = run
+        self.sample = sample
+        self.gsm = gsm
+        self.urls = urls
+        self.sizes = sizes  # in bytes, None when unknown
+        self.md5s = md5s
+        self.reads = reads
+        self.series = ""
+        self.fields = {}
+
+    def __repr__(self):
+        return "Run({}, {}, {} files)".format(self.run, self.sample, len(self.urls))
+
+
+def table_runs(args, table, map_dict, log=None):
+    """Check the metadata and yield the Run of the samples selected, in the order
+    of the metadata file"""
+    for column in [args.colname, "fastq_ftp"]:
+        if column not in table.columns:
+            raiseError(
+                "  > ERROR: Column {col} not in the metadata file "
+                "{meta}".format(col=column, meta=table.path)
+            )
+    # check that the column selected for naming is uniq
+    if table.duplicates() and not args.merge:
+        raiseError(
+            "  > ERROR: Non uniq sample names in the column {col} "
+            "of the meta file {meta}\n".format(col=args.colname, meta=table.path)
+        )
+
+    for i in table.select(args.samples):
+        gsm = ""
+        if args.mode == "geo":
+            gsm = table.gsms[i]
+            if not gsm:
+                raiseError("  > ERROR: Regexp did not match...")
+            try:
+                outname = map_dict[gsm].replace(" ", "_")
+            except KeyError:
+                raiseError(
+                    "  > ERROR: The GSM {} was not found in the GEO page...  exiting!".format(
+                        gsm
+                    )
+                )
+            if log is not None:
+                log.write(gsm + " --> " + outname + "\n")
+        else:
+            outname = table.get(i, args.colname).replace(" ", "_")
+        sizes = table.get(i, "fastq_bytes").split(";")
+        reads = table.get(i, "read_count")
+        run = Run(
+            table.runs[i],
+            outname,
+            table.get(i, "fastq_ftp").split(";"),
+            sizes=[int(size) if size else None for size in sizes],
+            md5s=table.get(i, "fastq_md5").split(";"),
+            reads=int(reads) if reads else None,
+            gsm=gsm,
+        )
+        run.series = args.inputvalue
+        run.fields = dict(zip(table.header, table.rows[i]))
+        yield run
+
+
+def plan_runs(args, runs):
+    """The list of Transfer fetching the files of the `runs` in the --shard"""
+    transfers = []
+    layouts = {}  # sample name -> number of files of its runs
+    for run in runs:
+        if not in_shard(args, run.sample):
+            continue
+        data_urls, outname = run.urls, run.sample
+        if len(data_urls) == 2:  # paired end
+            suffix = ["_R1", "_R2"]
+        elif len(data_urls) == 1:  # single end
+            suffix = [""]
+        else:
+            raiseError(" > ERROR: number of urls in fastq url column is unexpected")
+        if layouts.setdefault(outname, len(data_urls)) != len(data_urls):
+            raiseError(
+                "  > ERROR: {} mixes single and paired end runs, "
+                "they cannot be merged".format(outname)
+            )
+        for r, url in enumerate(data_urls):
+            transfer = Transfer(
+                outname + suffix[r],
+                url,
+                outpath(args, outname + suffix[r] + ".fq.gz"),
+                run=run.run,
+                size=run.sizes[r] if len(run.sizes) > r else None,
+                md5=run.md5s[r] if len(run.md5s) > r else "",
+                reads=run.reads,
+            )
+            transfer.series = run.series
+            if args.max_reads or args.max_bytes:  # streamed by geoDL
+                transfer.sample = ",".join(
+                    "{}={}".format(name, value)
+                    for name, value in [
+                        ("max_reads", args.max_reads),
+                        ("max_bytes", args.max_bytes),
+                    ]
+                    if value
+                )
+                transfer.size, transfer.md5, transfer.reads = None, "", None
+            else:
+                transfer.cmd = transfer_cmd(args, args.engine, transfer)
+            if r == 1:
+                transfer.mate, transfers[-1].mate = transfers[-1], transfer
+            transfers.append(transfer)
+    if args.merge:
+        merge_transfers(transfers)
+    return transfers
+
+
+def merge_transfers(transfers):
+    """Give the transfers sharing an output file their offset in it, from the
+    sizes of the files before them. Each run stays a complete gzip member"""
+    groups = {}
+    for transfer in transfers:
+        groups.setdefault(transfer.outfile, []).append(transfer)
+    for group in groups.values():
+        if len(group) == 1:
+            continue
+        offset = 0
+        for transfer in group:
+            if transfer.size is None:
+                raiseError(
+                    "  > ERROR: --merge needs the fastq_bytes of {} ({})".format(
+                        transfer.run, transfer.outfile
+                    )
+                )
+            transfer.offset, transfer.group, transfer.cmd = offset, group, None
+            offset += transfer.size
+
+
+PLAN_FORMATS = ["cmds", "aria2", "ascp", "json", "tsv"]
+PLAN_COLUMNS = ["run", "name", "url", "outfile", "size", "md5", "series"]
+
+
+def write_plan(args, transfers):
+    """Write the transfers for another program, in `args.plan_format`, to
+    `args.plan_out`. The commands of geoDL are shown on screen by default"""
+    path = args.plan_out
+    if path is None and args.plan_format == "cmds":
+        for transfer in transfers:
+            echo(transfer.describe(args))
+        return
+    if path is None:
+        path = outpath(args, "geoDL.plan." + args.plan_format)
+    out = sys.stdout if path == "-" else open(path, "w")
+    try:
+        for line in plan_lines(args, transfers):
+            out.write(line + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if path == "-":
+        return
+    echo("{} files planned in {}".format(len(transfers), path))
+    if args.plan_format == "aria2":
+        echo("  > aria2c --input-file {} --check-integrity=true".format(path))
+    elif args.plan_format == "ascp":
+        echo(
+            "  > ascp -QT -l 300m -P 33001 -i {} --mode=recv --user=era-fasp "
+            "--host=fasp.sra.ebi.ac.uk --file-pair-list={} .".format(
+                args.asperakey, path
+            )
+        )
+
+
+def plan_lines(args, transfers):
+    """The lines of the plan of the transfers in `args.plan_format`"""
+    if args.plan_format == "cmds":
+        for transfer in transfers:
+            yield transfer.describe(args)
+    elif args.plan_format == "aria2":
+        for transfer in transfers:
+            yield "{}://{}".format(args.protocol, transfer.url)
+            yield "  dir=" + (os.path.dirname(transfer.outfile) or ".")
+            yield "  out=" + os.path.basename(transfer.outfile)
+            if transfer.md5:
+                yield "  checksum=md5=" + transfer.md5
+    elif args.plan_format == "ascp":  # source on the Aspera server, destination
+        for transfer in transfers:
+            yield "/" + transfer.url.split("/", 1)[-1]
+            yield transfer.outfile
+    else:
+        records = (
+            dict(
+                zip(
+                    PLAN_COLUMNS,
+                    [
+                        transfer.run,
+                        transfer.name,
+                        "{}://{}".format(args.protocol, transfer.url),
+                        transfer.outfile,
+                        transfer.size,
+                        transfer.md5,
+                        transfer.series,
+                    ],
+                )
+            )
+            for transfer in transfers
+        )
+        if args.plan_format == "tsv":
+            yield "\t".join(PLAN_COLUMNS)
+            for record in records:
+                yield "\t".join(
+                    "" if record[c] is None else str(record[c]) for c in PLAN_COLUMNS
+                )
+        else:  # one file per line, still a single json document
+            yield "["
+            for i, record in enumerate(records):
+                yield ("  " if not i else ", ") + json.dumps(record)
+            yield "]"
+
+
+def transfer_cmd(args, transport, transfer):
+    """Command line of wget or ascp getting `transfer`, None for the transports of
+    the native engine"""
+    if transport == "ascp":
+        return [
+            args.ascp_bin,
+            "-T",
+            "--policy",
+            "high",
+            "-l",
+            "{}M".format(int(args.max_rate * 8 / args.jobs / 1e6) or 1)
+            if args.max_rate
+            else "10G",
+            "-i",
+            args.asperakey,
+            "-P",
+            "33001",
+            "-k",
+            "1",
+            transfer.url.replace("ftp.sra.ebi.ac.uk", "era-fasp@fasp.sra.ebi.ac.uk:"),
+            transfer.outfile,
+        ]
+    if transport == "wget":
+        cmd = [
+            "wget",
+            "-nv",  # the progress line replaces the bars
+            "--no-use-server-timestamps",
+            "-nH",
+            "-c",
+            "ftp://" + transfer.url,
+            "-O",
+            transfer.outfile,
+        ]
+        if args.max_rate:
+            cmd.insert(1, "--limit-rate={}".format(args.max_rate // args.jobs))
+        return cmd
+    return None
+
+
+PROBE_BYTES = 4 * 1024 ** 2
+PROBE_TIMEOUT = 15
+
+
+def probe_transports(args, transfer, session):
+    """Time the first PROBE_BYTES of `transfer` over Aspera (when installed),
+    HTTPS and FTP, one after the other, and return the transports fastest first.
+    Those which failed come last, as a last resort"""
+    folder = tempfile.mkdtemp(prefix=".probe", dir=args.outdir)
+    probe = Transfer(transfer.name, transfer.url, os.path.join(folder, "probe"))
+    candidates = ["https", "ftp"]
+    if args.ascp_bin and os.path.isfile(args.asperakey):
+        candidates.insert(0, "ascp")
+    rates = {}
+    echo("Timing the transports on {}...".format(transfer.url))
+    try:
+        for transport in candidates:
+            start = time.time()
+            try:
+                if transport == "ascp":
+                    cmd = transfer_cmd(args, transport, probe)
+                    cmd.insert(1, "-@0:{}".format(PROBE_BYTES))
+                    with open(os.devnull, "w") as devnull:
+                        ret = call(cmd, stdout=devnull, timeout=PROBE_TIMEOUT)
+                    nbytes = os.path.getsize(probe.outfile) if ret == 0 else 0
+                else:
+                    url = "{}://{}".format(transport, transfer.url)
+                    size, _ = remote_size(url, session, PROBE_TIMEOUT)
+                    fd = os.open(probe.outfile, os.O_WRONLY | os.O_CREAT, 0o644)
+                    try:
+                        nbytes = fetch_range(
+                            url,
+                            fd,
+                            0,
+                            min(size, PROBE_BYTES),
+                            session,
+                            timeout=PROBE_TIMEOUT,
+                        )
+                    finally:
+                        os.close(fd)
+            except Exception as e:  # timeouts, refused connections, bad answers
+                echo("  > {}: failed ({})".format(transport, e))
+                nbytes = 0
+            duration = time.time() - start
+            EventLog.of(args).emit(
+                "probe",
+                transport=transport,
+                url=transfer.url,
+                bytes=nbytes,
+                duration=round(duration, 3),
+                throughput=round(nbytes / duration, 1) if duration else None,
+            )
+            if nbytes:
+                rates[transport] = nbytes / duration
+                echo("  > {}: {}/s".format(transport, format_size(rates[transport])))
+            if os.path.exists(probe.outfile):
+                os.remove(probe.outfile)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    if not rates:
+        echo(Fore.RED + "  > No transport answered, trying them all" + Fore.RESET)
+    ranked = sorted(rates, key=rates.get, reverse=True)
+    return ranked + [transport for transport in candidates if transport not in rates]
+
+
+def download(args, transfers, log):
+    """Run the transfers not already in the manifest, log them in order and
+    return the lists of the transfers skipped and failed"""
+    dlsoft = {"ascp": "aspera", "wget": "wget", "native": "geoDL", "auto": "geoDL"}[
+        args.engine
+    ]
+    echo("Starting the downloads with {}\n".format(dlsoft))
+    store = Store.from_args(args)
+    queue = WorkQueue.from_args(args)
+    skipped = []
+
+    def skip(transfer):
+        if transfer.status == "store":
+            echo(" > {} linked from the store".format(transfer.outfile))
+            log.write("STORE " + transfer.describe(args) + "\n")
+        else:
+            echo(" > {} already downloaded, skipping".format(transfer.outfile))
+            log.write("DONE " + transfer.describe(args) + "\n")
+        skipped.append(transfer)
+
+    if queue is None:
+        manifest = Manifest(outpath(args, MANIFEST))
+        todo, done = pending(transfers, manifest, store)
+        for transfer in done:
+            skip(transfer)
+        results = run_transfers(args, todo, manifest, store=store)
+    else:
+        results = queue_transfers(args, queue, transfers, store, skip)
+
+    failed = []
+    for transfer, ret in results:
+        if ret != 0:
+            failed.append(transfer)
+            echo(
+                Fore.RED
+                + "  > ERROR: {} returned {} for {}".format(
+                    dlsoft, ret, transfer.outfile
+                )
+                + Fore.RESET
+            )
+            echo("  > cmd was: \n{}".format(transfer.describe(args)))
+            log.write("FAILED ({}) ".format(ret))
+        elif transfer.status:
+            log.write("PASS ")
+        if transfer.status:
+            log.write("[{}] ".format(transfer.status))
+        log.write(transfer.describe(args) + "\n")
+        log.flush()
+
+    if failed:
+        echo(
+            Fore.RED
+            + "\n > {} of {} downloads failed:".format(len(failed), len(transfers))
+            + Fore.RESET
+        )
+        for transfer in failed:
+            echo("   - {}".format(transfer.outfile))
+    if queue is not None:
+        echo("\n".join([""] + queue.report()))
+    return skipped, failed
+
+
+def queue_transfers(args, queue, transfers, store, skip):
+    """run_transfers through the WorkQueue: a worker claims the task of a file
+    before looking at it, the ones already there are given to `skip`. Once the
+    transfers are through, the tasks that failed elsewhere or whose process
+    stopped are taken over, until all the tasks are over"""
+    files = {}
+    for transfer in transfers:
+        files[task_key(transfer)] = files.get(task_key(transfer), 0) + 1
+    queue.add(files)
+    while transfers:
+        manifest = Manifest(outpath(args, MANIFEST))  # with the other processes'
+
+        def claim(transfer):
+            if not queue.claim(task_key(transfer)):
+                return False
+            todo, done = pending([transfer], manifest, store)
+            if done:
+                skip(transfer)
+                queue.finish(task_key(transfer), True)
+            return bool(todo)
+
+        for transfer, ret in run_transfers(
+            args, transfers, manifest, store=store, claim=claim
+        ):
+            if ret is not None:
+                queue.finish(task_key(transfer), ret == 0, transfer.nbytes)
+                yield transfer, ret
+        transfers = queue.waiting(transfers, task_key)
+
+
+def pending(transfers, manifest, store=None):
+    """Split the transfers into the ones to do and the ones already in the
+    manifest or linked from the `store`, which get the status "store". The
+    leftovers of another run or sample are removed"""
+    todo = []
+    skipped = []
+    for transfer in transfers:
+        md5 = transfer.md5 if transfer.group is None else ""  # no md5 for merges
+        if manifest.is_done(transfer.outfile, transfer.record, md5) or (
+            transfer.sample and manifest.is_done(transfer.outfile, transfer.run)
+        ):
+            skipped.append(transfer)
+            continue
+        stored = None
+        if store is not None and transfer.md5 and transfer.record == transfer.run:
+            stored = store.lookup(transfer.run, transfer.md5, ".fq.gz")
+        if stored is not None and store.link(stored, transfer.outfile):
+            manifest.add(
+                transfer.outfile,
+                transfer.run,
+                os.path.getsize(transfer.outfile),
+                transfer.md5,
+            )
+            transfer.status = "store"
+            skipped.append(transfer)
+            continue
+        entry = manifest.entries.get(transfer.outfile)
+        if entry is not None and entry[0] != transfer.record:
+            # a sample, or another run: not something to resume from
+            if os.path.exists(transfer.outfile):
+                os.remove(transfer.outfile)
+        elif os.path.exists(transfer.outfile):
+            if os.stat(transfer.outfile).st_nlink > 1:  # shared with the store
+                os.remove(transfer.outfile)
+        todo.append(transfer)
+    return todo, skipped
+
+
+def run_transfers(
+    args, transfers, manifest=None, ordered=True, store=None, claim=None
+):
+    """Run the transfers on a pool of `args.jobs` workers, with at most
+    `args.host_connections` connections to the same host at once. Yield the
+    (transfer, return code) pairs in the order of `transfers`, as soon as every
+    transfer before them is done, or as soon as they are over when not `ordered`.
+    Unless `args.verify` is off, the md5, gzip stream and read count of every file
+    are checked as it is written (after the fact for wget and ascp). Successful
+    transfers are recorded in the `manifest`, and added to the `store` when their
+    md5 is the one of ENA. When `claim` is given, a worker only runs a transfer
+    if claim(transfer) is true at the time it picks it, the code of the others is
+    None.
+
+    The transfers start in `args.order`, largest first by default, and one is
+    refused when the free disk space cannot hold it. The total rate is capped at
+    `args.max_rate` and the overall progress is shown on a single line.
+
+    With the auto engine, the transports are timed once and a file that fails or
+    does not pass the checks over one is tried again over the next one"""
+    if not transfers:
+        return
+    if args.order == "metadata":
+        schedule = list(transfers)
+    else:
+        schedule = sorted(
+            transfers,
+            key=lambda t: -1 if t.size is None else t.size,
+            reverse=args.order == "largest",
+        )
+    progress = Progress(transfers, args.max_rate)
+    admission = DiskAdmission()
+    events = EventLog.of(args)
+    sampling = bool(args.max_reads or args.max_bytes)
+    external = [t for t in transfers if t.cmd is not None]
+    if len(external) < len(transfers):
+        session = download_session(args.jobs * args.segments)
+    if external:
+        tool = external[0].cmd[0]
+        if not tool or shutil.which(tool) is None:
+            raiseError(
+                "  > ERROR: {} not found, please install and try again !".format(
+                    tool or "ascp"
+                )
+            )
+    if args.engine == "auto":
+        routes = probe_transports(args, schedule[0], session)
+    elif args.engine == "native":
+        routes = [args.protocol]
+    else:
+        routes = [args.engine]
+    # samples and merged runs are written by geoDL itself
+    streamed = [r for r in routes if r in ["https", "http", "ftp"]] or [args.protocol]
+    pair_lock = threading.Lock()
+    merged = {}  # output file -> transfers of its group done
+    # a native transfer opens up to --segments connections to its host
+    segments = min(args.segments, args.host_connections)
+    host_slots = {}
+    for transfer in transfers:
+        if transfer.host not in host_slots:
+            host_slots[transfer.host] = HostSlots(args.host_connections)
+
+    def fetch(transfer, check):
+        if transfer.cmd is not None:
+            before = progress.size_on_disk(transfer)
+            ret = call_until(transfer.cmd, progress.cancelled)
+            transfer.nbytes = progress.size_on_disk(transfer) - before
+            if ret == 0 and check is not None:  # external tools: one read back
+                check.read_file(transfer.outfile)
+            return ret
+        url = "{}://{}".format(transfer.transport, transfer.url)
+        if sampling:
+            try:
+                transfer.nbytes, transfer.sampled = sample_download(
+                    url,
+                    transfer.outfile,
+                    session,
+                    args.max_reads,
+                    args.max_bytes,
+                    progress,
+                )
+            except (IOError, OSError, zlib.error, ftplib.Error) as e:
+                echo(
+                    Fore.RED
+                    + "  > ERROR: could not sample {}: {}".format(url, e)
+                    + Fore.RESET
+                )
+                return 1
+            if check is not None:
+                check.read_file(transfer.outfile)
+            return 0
+        try:
+            transfer.nbytes = native_download(
+                url,
+                transfer.outfile,
+                segments,
+                session,
+                check,
+                meter=progress,
+                on_allocated=lambda: admission.release(transfer),
+                offset=transfer.offset,
+                expected=transfer.size,
+            )
+        except (IOError, OSError, EOFError, ftplib.Error) as e:
+            echo(
+                Fore.RED
+                + "  > ERROR: could not get {}: {}".format(url, e)
+                + Fore.RESET
+            )
+            return 1
+        return 0
+
+    def via(transfer, transport, again=False):
+        """Get `transfer` over one transport and check it, return the exit code
+        and the md5 of the file"""
+        transfer.transport = transport
+        if args.engine == "auto":
+            transfer.cmd = transfer_cmd(args, transport, transfer)
+        progress.started(transfer, again)
+        check = StreamCheck(args.count_reads) if args.verify else None
+        ret = fetch(transfer, check)
+        if ret != 0 or check is None:
+            return ret, ""
+        errors = check.errors(transfer)
+        transfer.status = check.summary()
+        if errors:
+            echo(
+                Fore.RED
+                + "  > ERROR: {} is corrupted: {}".format(
+                    transfer.outfile, ", ".join(errors)
+                )
+                + Fore.RESET
+            )
+            if check.corrupted and transfer.offset is not None:
+                # the other runs share the file: only this one is fetched again
+                part_state(transfer.outfile, transfer.offset).remove()
+            elif check.corrupted:  # do not resume from bad bytes
+                os.remove(transfer.outfile)
+            return 1, ""
+        return 0, check.md5.hexdigest()
+
+    def worker(transfer):
+        if progress.cancelled.is_set():
+            raise Cancelled("the transfers were cancelled")
+        if claim is not None and not claim(transfer):
+            progress.dropped(transfer)
+            return None
+        start = time.time()
+        ret = attempt(transfer)
+        duration = time.time() - start
+        events.emit(
+            "transfer",
+            file=transfer.outfile,
+            run=transfer.run,
+            url=transfer.url,
+            host=transfer.host,
+            engine=transfer.transport,
+            bytes=transfer.nbytes,
+            duration=round(duration, 3),
+            throughput=round(transfer.nbytes / duration, 1) if duration else None,
+            exit=ret,
+            retries=transfer.retries,
+            status=transfer.status,
+        )
+        return ret
+
+    def attempt(transfer):
+        connections = 1 if transfer.cmd is not None or sampling else segments
+        with host_slots[transfer.host].take(connections):
+            echo(
+                Fore.GREEN
+                + "\n > Getting {}...\n".format(transfer.name)
+                + 80 * "="
+                + Fore.RESET
+            )
+            if not admission.admit(transfer):
+                echo(
+                    Fore.RED
+                    + "  > ERROR: not enough space left for {} ({})".format(
+                        transfer.outfile, format_size(transfer.size)
+                    )
+                    + Fore.RESET
+                )
+                progress.finished(transfer, False)
+                return errno.ENOSPC
+            try:
+                tries = routes
+                if sampling or transfer.group is not None:
+                    tries = streamed
+                for n, transport in enumerate(tries):
+                    if n:
+                        echo(
+                            Fore.RED
+                            + "  > {} failed for {}, trying {}".format(
+                                tries[n - 1], transfer.name, transport
+                            )
+                            + Fore.RESET
+                        )
+                    transfer.retries = n
+                    ret, md5 = via(transfer, transport, again=n > 0)
+                    if ret == 0:
+                        break
+            finally:
+                admission.release(transfer)
+        progress.finished(transfer, ret == 0)
+        if ret != 0:
+            return ret
+        if transfer.group is not None:
+            join_group(transfer)
+        elif manifest is not None:
+            manifest.add(
+                transfer.outfile,
+                transfer.record,
+                os.path.getsize(transfer.outfile),
+                md5,
+            )
+        # samples and merges are not stored, nor files without the md5 of ENA
+        if store is not None and transfer.record == transfer.run:
+            if md5 and md5 == transfer.md5:
+                store.put(transfer.outfile, transfer.run, md5, ".fq.gz")
+        if transfer.sampled is not None and transfer.mate is not None:
+            pair_up(transfer)
+        return ret
+
+    def join_group(transfer):
+        """Record a merged output once all its runs are in"""
+        with pair_lock:
+            done = merged.setdefault(transfer.outfile, set())
+            done.add(transfer)
+            if len(done) < len(transfer.group):
+                return
+        for part in transfer.group:
+            part_state(part.outfile, part.offset).remove()
+        if manifest is not None:
+            manifest.add(
+                transfer.outfile,
+                transfer.record,
+                os.path.getsize(transfer.outfile),
+                "",
+            )
+
+    def pair_up(transfer):
+        """Once both files of a sampled pair are there, cut the longer one to the
+        reads of the other: the limit in bytes rarely ends on the same read"""
+        with pair_lock:
+            mate = transfer.mate
+            if mate.sampled is None or mate.sampled == transfer.sampled:
+                return
+            longer = max(transfer, mate, key=lambda t: t.sampled)
+            shorter = mate if longer is transfer else transfer
+            echo(
+                "  > {} cut to the {} reads of {}".format(
+                    longer.outfile, shorter.sampled, shorter.name
+                )
+            )
+            trim_fastq(longer.outfile, shorter.sampled)
+            longer.sampled = shorter.sampled
+            if manifest is not None:
+                manifest.add(
+                    longer.outfile,
+                    longer.record,
+                    os.path.getsize(longer.outfile),
+                    file_md5(longer.outfile),
+                )
+
+    pool = ThreadPoolExecutor(max_workers=args.jobs)
+    if args.progress:
+        progress.show()
+    futures = {}
+    try:
+        futures = dict((t, pool.submit(worker, t)) for t in schedule)
+        jobs = dict((future, t) for t, future in futures.items())
+        if not ordered:
+            for future in as_completed(futures.values()):
+                yield jobs[future], future.result()
+            return
+        for transfer in transfers:
+            yield transfer, futures[transfer].result()
+    finally:  # Ctrl-C, or the caller stopped: the transfers left go no further
+        progress.cancelled.set()
+        for future in futures.values():
+            future.cancel()
+        pool.shutdown(wait=False)
+        progress.stop()
+
+
+class Progress(object):
+    """Aggregate progress of the transfers, shown on a single line. The native
+    engine reports its bytes with `add`, which also holds the total rate under
+    `max_rate`; the files of wget and ascp are looked at on disk"""
+
+    def __init__(self, transfers, max_rate=None, interval=None):
+        self.total = sum(t.size or 0 for t in transfers)
+        self.files = len(transfers)
+        self.max_rate = max_rate
+        self.tty = sys.stdout.isatty()
+        self.interval = interval or (1 if self.tty else 30)
+        self.start = time.time()
+        self.bytes = 0  # bytes downloaded by this run
+        self.present = 0  # bytes already there when the transfers started
+        self.external = {}  # wget/ascp transfer -> size of its file at start
+        self.done = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+        self.stopped = threading.Event()
+        self.cancelled = threading.Event()
+        self.shown = False
+
+    def add(self, nbytes):
+        """Count bytes received and sleep as long as needed to respect max_rate.
+        Raise Cancelled once the transfers are cancelled"""
+        if self.cancelled.is_set():
+            raise Cancelled("the transfers were cancelled")
+        with self.lock:
+            self.bytes += nbytes
+            if not self.max_rate:
+                return
+            now = time.time()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + float(nbytes) / self.max_rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def size_on_disk(self, transfer):
+        try:
+            return os.path.getsize(transfer.outfile)
+        except OSError:
+            return 0
+
+    def started(self, transfer, again=False):
+        """The transfer starts, or starts `again` over another transport"""
+        with self.lock:
+            if transfer in self.external:
+                self.bytes += self.size_on_disk(transfer) - self.external.pop(transfer)
+            if transfer.cmd is not None:
+                self.external[transfer] = self.size_on_disk(transfer)
+                if not again:
+                    self.present += self.external[transfer]
+
+    def dropped(self, transfer):
+        """The transfer is left to another process"""
+        with self.lock:
+            self.files -= 1
+            self.total -= transfer.size or 0
+
+    def finished(self, transfer, ok):
+        with self.lock:
+            if transfer in self.external:
+                self.bytes += self.size_on_disk(transfer) - self.external.pop(transfer)
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+                self.total -= transfer.size or 0  # not coming anymore
+
+    def line(self):
+        with self.lock:
+            got = self.bytes + sum(
+                self.size_on_disk(t) - size for t, size in self.external.items()
+            )
+            elapsed = max(time.time() - self.start, 1e-3)
+            running = self.files - self.done - self.failed
+            rate = got / elapsed
+            left = max(self.total - self.present - got, 0)
+        eta = "--:--:--"
+        if rate > 0 and self.total:
+            minutes, seconds = divmod(int(left / rate), 60)
+            eta = "{:02d}:{:02d}:{:02d}".format(minutes // 60, minutes % 60, seconds)
+        return " > {} / {} | {}/s | ETA {} | {} done, {} failed, {} to go".format(
+            format_size(got),
+            format_size(max(self.total - self.present, 0)),
+            format_size(rate),
+            eta,
+            self.done,
+            self.failed,
+            running,
+        )
+
+    def show(self):
+        """Print the progress line every `interval` seconds until stopped"""
+        self.shown = True
+
+        def loop():
+            while not self.stopped.wait(self.interval):
+                if self.tty:
+                    sys.stdout.write("\r\033[K" + Fore.BLUE + self.line() + Fore.RESET)
+                    sys.stdout.flush()
+                else:
+                    echo(self.line())
+
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        echo(("\r\033[K" if self.tty and self.shown else "") + self.line())
+
+
+class Cancelled(Exception):
+    """The transfers were stopped, eg: by Ctrl-C"""
+
+
+def call_until(cmd, cancelled):
+    """Run `cmd` like subprocess.call, terminating it once `cancelled` is set"""
+    proc = Popen(cmd)
+    while proc.poll() is None:
+        if cancelled.wait(0.5):
+            proc.terminate()
+            proc.wait()
+            raise Cancelled("the transfers were cancelled")
+    return proc.returncode
+
+
+class DiskAdmission(object):
+    """Refuse to start a transfer when the free space of its file system, minus
+    what the running transfers will still write, cannot hold it"""
+
+    def __init__(self):
+        self.reserved = {}
+        self.lock = threading.Lock()
+
+    def admit(self, transfer):
+        if transfer.size is None:
+            return True
+        folder = os.path.dirname(os.path.abspath(transfer.outfile))
+        try:
+            need = transfer.size
+            if transfer.offset is None:
+                need -= os.path.getsize(transfer.outfile)
+        except OSError:
+            need = transfer.size
+        with self.lock:
+            free = shutil.disk_usage(folder).free - sum(self.reserved.values())
+            if need > free:
+                return False
+            self.reserved[transfer] = max(need, 0)
+            return True
+
+    def release(self, transfer):
+        """The transfer is over, or its file is preallocated"""
+        with self.lock:
+            self.reserved.pop(transfer, None)
+
+
+class HostSlots(object):
+    """At most `size` connections to one host: a transfer takes a slot for each
+    connection it opens"""
+
+    def __init__(self, size):
+        self.size = size
+        self.slots = threading.Semaphore(size)
+        self.lock = threading.Lock()  # one transfer gathers its slots at a time
+
+    @contextlib.contextmanager
+    def take(self, connections):
+        connections = min(connections, self.size)
+        with self.lock:
+            for _ in range(connections):
+                self.slots.acquire()
+        try:
+            yield
+        finally:
+            for _ in range(connections):
+                self.slots.release()
+
+
+MANIFEST = "geoDL.manifest"
+
+
+class Manifest(object):
+    """Append-only tab separated record of the files fully downloaded:
+    file, run accession, size and md5. The last line of a file wins"""
+
+    header = ["file", "run_accession", "bytes", "md5"]
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    sp = line.rstrip("\n").split("\t")
+                    if len(sp) == 4 and sp != self.header:
+                        self.entries[sp[0]] = (sp[1], int(sp[2]), sp[3])
+
+    def is_done(self, outfile, run, md5=""):
+        """Whether `outfile` is recorded for this run, has the recorded size on disk
+        and, when both are known, the expected md5. Files downloaded with
+        --no-verify are recorded without one"""
+        entry = self.entries.get(outfile)
+        if entry is None or entry[0] != run or not os.path.exists(outfile):
+            return False
+        if md5 and entry[2] and md5 != entry[2]:
+            return False
+        return os.path.getsize(outfile) == entry[1]
+
+    def add(self, outfile, run, size, md5):
+        with self.lock:
+            self.entries[outfile] = (run, size, md5)
+            with open(self.path, "a") as f:
+                if fcntl is not None:  # other processes on a shared file system
+                    fcntl.lockf(f, fcntl.LOCK_EX)
+                if not os.fstat(f.fileno()).st_size:
+                    f.write("\t".join(self.header) + "\n")
+                f.write("\t".join([outfile, run, str(size), md5]) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class Store(object):
+    """Content-addressed store of the downloaded files, shared by the geoDL runs
+    of a site: DIR/<run accession>/<md5><ext>, hard-linked (or reflinked, or
+    copied across file systems or users) into the output directories. The
+    objects are read-only, the folders and files geoDL keeps there are writable
+    by the group of their owner, and keep the group of DIR when it is set-group-ID
+    (chmod g+s DIR). Each use of an object is logged in DIR/.atimes, so that the
+    least recently used ones are removed first when the store grows past
+    `max_size` bytes. The changes are made under a lock file, which holds across
+    processes and machines sharing the directory. When the store cannot be read
+    or written, the files are downloaded as without it"""
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.atimes = os.path.join(path, ".atimes")
+        self.warned = False
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:  # another process made it
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                share(path, 0o2000)
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.store:
+            return None
+        try:
+            return cls(args.store, args.store_size)
+        except OSError as e:
+            store_warning(args.store, e)
+            return None
+
+    def failed(self, error):
+        """Tell once that the store does not work"""
+        if not self.warned:
+            self.warned = True
+            store_warning(self.path, error)
+
+    def append(self, path):
+        """Open `path` to append to it, created shared with the group"""
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        share(path)
+        return os.fdopen(fd, "a")
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the store for this thread and process. lockf takes a POSIX lock,
+        which NFS forwards to the server unlike flock"""
+        with self.lock:
+            with self.append(os.path.join(self.path, ".lock")) as f:
+                if fcntl is not None:
+                    fcntl.lockf(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def used(self, path):
+        """Log a use of the object `path`, under the lock: the objects of other
+        users cannot have their mtime changed"""
+        with self.append(self.atimes) as f:
+            f.write("{}\t{}\n".format(os.path.relpath(path, self.path), time.time()))
+
+    def lookup(self, run, md5, ext):
+        """Path of the object of `run` with this md5, or any of its objects with
+        this extension when the md5 is not known. None if there is none"""
+        if md5:
+            path = os.path.join(self.path, run, md5 + ext)
+            return path if os.path.isfile(path) else None
+        try:
+            names = sorted(os.listdir(os.path.join(self.path, run)))
+        except OSError:
+            return None
+        for name in names:
+            if name.endswith(ext) and not name.startswith("."):
+                return os.path.join(self.path, run, name)
+        return None
+
+    def link(self, path, outfile):
+        """Put the object `path` at `outfile`, return False if it was evicted or
+        the store failed"""
+        tmp = outfile + ".store"
+        try:
+            with self.locked():
+                if not os.path.isfile(path):
+                    return False
+                place(path, tmp)
+                os.rename(tmp, outfile)
+                self.used(path)
+        except (IOError, OSError) as e:
+            self.failed(e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def put(self, outfile, run, md5, ext):
+        """Add the downloaded `outfile` to the store, then make room"""
+        path = os.path.join(self.path, run, md5 + ext)
+        tmp = os.path.join(self.path, run, ".{}.{}".format(md5, os.getpid()))
+        try:
+            with self.locked():
+                if not os.path.isfile(path):
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                        share(os.path.dirname(path))
+                    place(outfile, tmp)
+                    os.chmod(tmp, 0o444)
+                    os.rename(tmp, path)
+                self.used(path)
+                if self.max_size is not None:
+                    self.evict(keep=path)
+        except (IOError, OSError) as e:
+            self.failed(e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def evict(self, keep=None):
+        """Remove the least recently used objects until the store fits, under the
+        lock. The log of their uses is rewritten with the ones left"""
+        used = {}
+        try:
+            with open(self.atimes) as f:
+                for line in f:
+                    name, _, when = line.rstrip("\n").partition("\t")
+                    try:
+                        used[name] = float(when)
+                    except ValueError:  # cut by a crash
+                        pass
+        except IOError:
+            pass
+        entries = []
+        for run in os.listdir(self.path):
+            folder = os.path.join(self.path, run)
+            if run.startswith(".") or not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name.startswith("."):  # being written
+                    continue
+                try:
+                    st = os.stat(os.path.join(folder, name))
+                except OSError:
+                    continue
+                name = os.path.join(run, name)
+                entries.append((used.get(name, st.st_mtime), st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        kept = []
+        for when, size, name in sorted(entries):
+            path = os.path.join(self.path, name)
+            if total <= self.max_size or path == keep:
+                kept.append((name, when))
+                continue
+            try:
+                os.remove(path)
+            except OSError:  # removed by another user only
+                kept.append((name, when))
+                continue
+            try:
+                os.rmdir(os.path.dirname(path))  # fails until the run is empty
+            except OSError:
+                pass
+            total -= size
+        tmp = "{}.{}".format(self.atimes, os.getpid())
+        with self.append(tmp) as f:
+            f.writelines("{}\t{}\n".format(name, when) for name, when in kept)
+        os.rename(tmp, self.atimes)
+
+
+def share(path, extra=0):
+    """Give the group of `path` the rights of its owner (when this user owns it),
+    plus the `extra` mode bits"""
+    st = os.stat(path)
+    if st.st_uid != os.geteuid():
+        return
+    mode = st.st_mode & 0o7777
+    shared = mode | (mode & 0o700) >> 3 | extra
+    if shared != mode:
+        os.chmod(path, shared)
+
+
+def store_warning(path, error):
+    echo(
+        Fore.YELLOW
+        + "  > WARNING: the store {} is not usable, downloading: {}".format(
+            path, error
+        )
+        + Fore.RESET
+    )
+
+
+class WorkQueue(object):
+    """Samples shared by geoDL processes, eg: on the nodes of a cluster, in a
+    SQLite file. A process claims a task (the files written together: mates and
+    merged runs) before downloading it, and holds a lease on it, renewed while it
+    runs. A task whose lease is over, or that failed elsewhere, can be claimed by
+    another process, at most `attempts` times"""
+
+    lease = 120  # seconds
+    attempts = 3
+
+    def __init__(self, path, owner=None):
+        import sqlite3
+
+        self.path = path
+        self.owner = owner or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        # the default rollback journal: WAL needs shared memory, not on NFS
+        self.db = sqlite3.connect(
+            path, timeout=600, isolation_level=None, check_same_thread=False
+        )
+        with self.transaction():
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, "
+                "files INTEGER, state TEXT, owner TEXT, lease REAL, "
+                "attempts INTEGER, done INTEGER, failed INTEGER, bytes INTEGER)"
+            )
+        thread = threading.Thread(target=self.renew)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.queue:
+            return None
+        return cls(args.queue)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def renew(self):
+        """Extend the leases of the tasks of this process until it exits"""
+        while True:
+            time.sleep(self.lease / 4.0)
+            with self.transaction() as db:
+                db.execute(
+                    "UPDATE tasks SET lease = ? WHERE owner = ? AND state = 'running'",
+                    (time.time() + self.lease, self.owner),
+                )
+
+    def add(self, keys):
+        """Add the tasks not in the queue yet, `keys` has their number of files"""
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO tasks VALUES (?, ?, 'todo', '', 0, 0, 0, 0, 0)",
+                sorted(keys.items()),
+            )
+
+    def free(self, state, owner, lease, attempts):
+        """Whether a task in this state can be claimed by this process"""
+        if state == "todo":
+            return True
+        if owner == self.owner or attempts >= self.attempts:
+            return False
+        return state == "failed" or (state == "running" and lease < time.time())
+
+    def claim(self, key):
+        """Take the task `key`, return False when another process has it or it
+        is over"""
+        with self.transaction() as db:
+            row = db.execute(
+                "SELECT state, owner, lease, attempts FROM tasks WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return False
+            if row[0] == "running" and row[1] == self.owner:
+                return True
+            if not self.free(*row):
+                return False
+            db.execute(
+                "UPDATE tasks SET state = 'running', owner = ?, lease = ?, "
+                "attempts = attempts + 1, done = 0, failed = 0, bytes = 0 "
+                "WHERE key = ?",
+                (self.owner, time.time() + self.lease, key),
+            )
+            return True
+
+    def finish(self, key, ok, nbytes=0):
+        """Count a file of the task `key` over, the task is once they all are"""
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE tasks SET done = done + ?, failed = failed + ?, "
+                "bytes = bytes + ? WHERE key = ? AND owner = ?",
+                (int(ok), int(not ok), nbytes, key, self.owner),
+            )
+            db.execute(
+                "UPDATE tasks SET state = CASE WHEN failed THEN 'failed' "
+                "ELSE 'done' END WHERE key = ? AND owner = ? "
+                "AND done + failed >= files",
+                (key, self.owner),
+            )
+
+    def waiting(self, items, key):
+        """The `items` whose task can be claimed now. While none can but other
+        processes still run some, wait for them to finish or stop"""
+        keys = set(key(item) for item in items)
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT key, state, owner, lease, attempts FROM tasks"
+                ).fetchall()
+            free = set()
+            running = False
+            for row in rows:
+                if row[0] not in keys:
+                    continue
+                if self.free(*row[1:]):
+                    free.add(row[0])
+                elif row[1] == "running" and row[3] >= time.time():
+                    running = True
+            if free or not running:
+                return [item for item in items if key(item) in free]
+            time.sleep(self.lease / 4.0)
+
+    def report(self):
+        """Lines summing up the tasks of all the processes"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, state, owner, done, failed, bytes FROM tasks ORDER BY key"
+            ).fetchall()
+        states = {}
+        owners = {}
+        for key, state, owner, done, failed, nbytes in rows:
+            states[state] = states.get(state, 0) + 1
+            if owner:
+                tasks, files, size = owners.get(owner, (0, 0, 0))
+                owners[owner] = (tasks + 1, files + done, size + nbytes)
+        lines = [
+            "Queue {}: {} samples, {}".format(
+                self.path,
+                len(rows),
+                ", ".join(
+                    "{} {}".format(n, state) for state, n in sorted(states.items())
+                ),
+            )
+        ]
+        for owner, (tasks, files, size) in sorted(owners.items()):
+            lines.append(
+                "   {}{}: {} samples, {} files, {}".format(
+                    owner,
+                    " (this process)" if owner == self.owner else "",
+                    tasks,
+                    files,
+                    format_size(size),
+                )
+            )
+        for key, state, owner, done, failed, nbytes in rows:
+            if state == "failed":
+                lines.append("   - {} failed on {}".format(key, owner))
+        return lines
+
+
+def task_key(transfer):
+    """Task of a transfer in the WorkQueue: its output file, the one of R1 for
+    both mates"""
+    if transfer.mate is not None and transfer.mate.outfile < transfer.outfile:
+        return transfer.mate.outfile
+    return transfer.outfile
+
+
+FICLONE = 0x40049409  # linux ioctl cloning a file on btrfs, xfs...
+
+
+def place(src, dst):
+    """Make `dst` the same file as `src`: a hard link, else a reflink (a copy on
+    write clone), else a plain copy"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:  # another file system, or no hard links there
+        pass
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                return
+            except (IOError, OSError):
+                pass
+        shutil.copyfileobj(fin, fout, 1024 ** 2)
+
+
+class StreamCheck(object):
+    """Check a file in a single pass over its bytes: md5, validity of the gzip
+    stream (members included) and, optionally, its number of reads.
+
+    The bytes are given with `feed(offset, chunk)` in any order. Chunks past the
+    next expected offset wait in memory up to `window` bytes, what does not fit
+    is read back from the file by `finish`, while still in the page cache."""
+
+    window = 64 * 1024 ** 2
+
+    def __init__(self, count_reads=False):
+        self.md5 = hashlib.md5()
+        self.count_reads = count_reads
+        self.inflate = zlib.decompressobj(31)
+        self.gzip_error = None
+        self.md5_error = None
+        self.lines = 0
+        self.nbytes = 0
+        self.pending = {}
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+
+    def update(self, chunk):
+        """Add the next bytes of the file"""
+        self.md5.update(chunk)
+        self.nbytes += len(chunk)
+        if self.gzip_error is not None:
+            return
+        try:
+            while chunk:
+                if self.inflate.eof:  # concatenated gzip members
+                    self.inflate = zlib.decompressobj(31)
+                data = self.inflate.decompress(chunk)
+                if self.count_reads:
+                    self.lines += data.count(b"\n")
+                chunk = self.inflate.unused_data if self.inflate.eof else b""
+        except zlib.error as e:
+            self.gzip_error = str(e)
+
+    def feed(self, offset, chunk):
+        """Add `chunk`, found at `offset` in the file"""
+        with self.lock:
+            if offset == self.nbytes:
+                self.update(chunk)
+                while self.nbytes in self.pending:
+                    chunk = self.pending.pop(self.nbytes)
+                    self.pending_bytes -= len(chunk)
+                    self.update(chunk)
+            elif offset > self.nbytes:
+                if self.pending_bytes + len(chunk) > self.window:
+                    return  # read back by finish
+                self.pending[offset] = chunk
+                self.pending_bytes += len(chunk)
+
+    def finish(self, fd, size, shift=0):
+        """Read back what was not fed in order, up to `size` bytes, the file
+        starting at `shift` in `fd`"""
+        with self.lock:
+            while self.nbytes < size:
+                chunk = self.pending.pop(self.nbytes, None)
+                if chunk is None:
+                    want = min(CHUNK_SIZE, size - self.nbytes)
+                    chunk = os.pread(fd, want, shift + self.nbytes)
+                    if not chunk:
+                        break
+                self.update(chunk)
+            self.pending.clear()
+            self.pending_bytes = 0
+
+    def read_file(self, path):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                self.update(chunk)
+
+    @property
+    def gzip_ok(self):
+        return self.gzip_error is None and self.inflate.eof
+
+    @property
+    def corrupted(self):
+        return self.md5_error is not None or not self.gzip_ok
+
+    def errors(self, transfer):
+        """List what does not match the expectations of `transfer`"""
+        errors = []
+        if transfer.md5 and self.md5.hexdigest() != transfer.md5:
+            self.md5_error = "md5 is {}, expected {}".format(
+                self.md5.hexdigest(), transfer.md5
+            )
+            errors.append(self.md5_error)
+        if not self.gzip_ok:
+            errors.append("invalid gzip ({})".format(self.gzip_error or "truncated"))
+        if self.count_reads and transfer.reads is not None:
+            if self.lines // 4 != transfer.reads:
+                errors.append(
+                    "{} reads, expected {}".format(self.lines // 4, transfer.reads)
+                )
+        return errors
+
+    def summary(self):
+        summary = "md5={} gzip={}".format(
+            self.md5.hexdigest(), "ok" if self.gzip_ok else "bad"
+        )
+        if self.count_reads:
+            summary += " reads={}".format(self.lines // 4)
+        return summary
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+SEGMENT_MIN_SIZE = 32 * 1024 ** 2
+CHUNK_SIZE = 1024 ** 2
+
+
+def download_session(pool_size):
+    """Return a requests session keeping up to `pool_size` connections alive per
+    host, shared by all the native downloads"""
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=max(pool_size, 1)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def split_ranges(size, segments):
+    """Split `size` bytes in at most `segments` (start, end) ranges, end excluded,
+    none smaller than SEGMENT_MIN_SIZE"""
+    segments = max(1, min(segments, size // SEGMENT_MIN_SIZE))
+    step = -(-size // segments)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def ftp_connect(host, timeout=60):
+    """Anonymous FTP session to `host`, which may carry a :port"""
+    host, _, port = host.partition(":")
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(host, int(port or 21))
+    ftp.login()
+    return ftp
+
+
+def remote_size(url, session, timeout=60):
+    """Return the size of the remote file and whether byte ranges can be asked"""
+    if url.startswith("ftp://"):
+        host, path = url[6:].split("/", 1)
+        ftp = ftp_connect(host, timeout)
+        try:
+            ftp.voidcmd("TYPE I")
+            return ftp.size("/" + path), True
+        finally:
+            ftp.close()
+    r = session.head(url, allow_redirects=True, timeout=timeout)
+    r.raise_for_status()
+    size = int(r.headers.get("Content-Length", 0))
+    return size, size > 0 and r.headers.get("Accept-Ranges") == "bytes"
+
+
+def iter_range(url, start, end, session, timeout=60):
+    """Yield the bytes [start, end) of `url` by chunks, until the end of the file
+    when `end` is None. Closing the generator closes the connection"""
+    if url.startswith("ftp://"):
+        host, path = url[6:].split("/", 1)
+        ftp = ftp_connect(host, timeout)
+        try:
+            ftp.voidcmd("TYPE I")
+            conn = ftp.transfercmd("RETR /" + path, rest=start or None)
+            try:
+                offset = start
+                while end is None or offset < end:
+                    want = CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - offset)
+                    chunk = conn.recv(want)
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    yield chunk
+            finally:
+                conn.close()
+        finally:
+            ftp.close()  # we may have stopped mid-file, do not wait for the 226
+    else:
+        headers = {}
+        if end is not None:
+            headers["Range"] = "bytes={}-{}".format(start, end - 1)
+        elif start:
+            headers["Range"] = "bytes={}-".format(start)
+        with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+            r.raise_for_status()
+            if headers:  # a 200 would be the whole file, not the range
+                m = re.match(r"bytes (\d+)-(\d+)/", r.headers.get("Content-Range", ""))
+                if (
+                    r.status_code != 206
+                    or m is None
+                    or int(m.group(1)) != start
+                    or (end is not None and int(m.group(2)) != end - 1)
+                ):
+                    raise IOError(
+                        "{} answered {} {} to the range {}".format(
+                            url,
+                            r.status_code,
+                            r.headers.get("Content-Range", "without Content-Range"),
+                            headers["Range"],
+                        )
+                    )
+            for chunk in r.iter_content(CHUNK_SIZE):
+                yield chunk
+
+
+def fetch_range(url, fd, start, end, session, progress=None, timeout=60, shift=0):
+    """Fetch the bytes [start, end) of `url` and pwrite them at the same offset,
+    plus `shift`, in the file descriptor `fd`. `end` is None to read until the end
+    of the file. `progress` is called with the offset and the bytes of each
+    write"""
+    offset = start
+    for chunk in iter_range(url, start, end, session, timeout):
+        os.pwrite(fd, chunk, offset + shift)
+        if progress is not None:
+            progress(offset, chunk)
+        offset += len(chunk)
+    if end is not None and offset != end:
+        raise EOFError(
+            "got {} of the {} bytes starting at {}".format(
+                offset - start, end - start, start
+            )
+        )
+    return offset - start
+
+
+def records_end(data, n):
+    """Offset just after the first `n` fastq records of `data`"""
+    lines = 4 * n
+    if lines == 0:
+        return 0
+    newlines = data.count(b"\n")
+    if newlines - lines < lines:  # closer from the end
+        pos = data.rfind(b"\n")
+        for _ in range(newlines - lines):
+            pos = data.rfind(b"\n", 0, pos)
+    else:
+        pos = -1
+        for _ in range(lines):
+            pos = data.find(b"\n", pos + 1)
+    return pos + 1
+
+
+def sample_fastq(chunks, out, max_reads=None, max_bytes=None):
+    """Decompress the fastq.gz `chunks` and write to the binary file `out` the
+    complete reads they hold, recompressed, stopping after `max_reads` reads or
+    `max_bytes` bytes of `chunks`. Return the bytes used and the reads written"""
+    inflate = zlib.decompressobj(31)
+    deflate = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = b""  # end of the decompressed data, not a complete read yet
+    used = reads = 0
+    for chunk in chunks:
+        if max_bytes is not None:
+            chunk = chunk[: max_bytes - used]
+        used += len(chunk)
+        data = [pending]
+        while chunk:
+            if inflate.eof:  # concatenated gzip members
+                inflate = zlib.decompressobj(31)
+            data.append(inflate.decompress(chunk))
+            chunk = inflate.unused_data if inflate.eof else b""
+        data = b"".join(data)
+        n = data.count(b"\n") // 4
+        if max_reads is not None:
+            n = min(n, max_reads - reads)
+        cut = records_end(data, n)
+        out.write(deflate.compress(data[:cut]))
+        pending = data[cut:]
+        reads += n
+        if reads == max_reads or used == max_bytes:
+            break
+    out.write(deflate.flush())
+    return used, reads
+
+
+def sample_download(url, outfile, session, max_reads=None, max_bytes=None, meter=None):
+    """Stream the start of the fastq.gz at `url` into `outfile` with
+    sample_fastq, closing the connection as soon as the limits are reached.
+    Return the bytes fetched and the reads written"""
+
+    def chunks():
+        for chunk in iter_range(url, 0, None, session):
+            if meter is not None:
+                meter.add(len(chunk))
+            yield chunk
+
+    stream = chunks()
+    try:
+        with open(outfile, "wb") as out:
+            return sample_fastq(stream, out, max_reads, max_bytes)
+    finally:
+        stream.close()
+
+
+def trim_fastq(path, reads):
+    """Cut the fastq.gz `path` to its first `reads` reads"""
+    tmp = path + ".trim"
+    with open(path, "rb") as f, open(tmp, "wb") as out:
+        sample_fastq(iter(lambda: f.read(CHUNK_SIZE), b""), out, reads)
+    os.rename(tmp, path)
+
+
+class SegmentState(object):
+    """Progress of the byte ranges of a native download, saved next to the file
+    (as <file>.geoDL) so that an interrupted download resumes where it stopped"""
+
+    save_every = 64 * 1024 ** 2
+
+    def __init__(self, path, url, size, parts, inode=None):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.parts = [list(part) for part in parts]  # [start, done, end]
+        self.inode = inode  # of the file written, None in older states
+        self.lock = threading.Lock()
+        self.unsaved = 0
+
+    @classmethod
+    def load(cls, path, url, size):
+        """Return the saved state if it is for the same url and size, else None"""
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if state.get("url") != url or state.get("size") != size:
+            return None
+        return cls(path, url, size, state["parts"], state.get("inode"))
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "url": self.url,
+                    "size": self.size,
+                    "parts": self.parts,
+                    "inode": self.inode,
+                },
+                f,
+            )
+        os.rename(tmp, self.path)
+
+    def tracker(self, i, check=None):
+        """Return the progress callback of the range `i`, also feeding `check`"""
+
+        def progress(offset, chunk):
+            if check is not None:
+                check.feed(offset, chunk)
+            with self.lock:
+                self.unsaved += len(chunk)
+                self.parts[i][1] = offset + len(chunk)
+                if self.unsaved >= self.save_every:
+                    self.save()
+                    self.unsaved = 0
+
+        return progress
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def part_state(outfile, offset):
+    """SegmentState file of the run written at `offset` in a merged output"""
+    return SegmentState("{}.{}.geoDL".format(outfile, offset), None, None, [])
+
+
+def native_download(
+    url,
+    outfile,
+    segments,
+    session,
+    check=None,
+    meter=None,
+    on_allocated=None,
+    offset=None,
+    expected=None,
+):
+    """Download `url` to `outfile` with the built-in engine. The file is
+    preallocated and its byte ranges fetched in parallel, each written in place.
+    An interrupted download resumes from its saved state, or from the end of the
+    existing file when there is no state. The bytes are fed to the StreamCheck
+    `check` as they arrive and counted by `meter`, which may slow them down.
+    `on_allocated` is called once the space of the file is reserved on disk.
+
+    With an `offset`, the file is one run of a merged output and is written from
+    there on, leaving the rest of the output alone. Its state is kept once it is
+    complete, until the other runs are in. When the `expected` size, the one of
+    the metadata, is not the one of the server, nothing is written and IOError is
+    raised: a merged run would overlap its neighbours. Return the number of bytes
+    fetched"""
+
+    def counted(progress):
+        if meter is None:
+            return progress
+
+        def count(offset, chunk):
+            meter.add(len(chunk))
+            if progress is not None:
+                progress(offset, chunk)
+
+        return count
+
+    size, ranges = remote_size(url, session)
+    if expected is not None and size and size != expected:
+        raise IOError(
+            "{} is {} bytes, the metadata gives {}".format(url, size, expected)
+        )
+    shift = offset or 0
+    statefile = outfile + ".geoDL"
+    if offset is not None:
+        statefile = part_state(outfile, offset).path
+    if not ranges or size == 0:
+        flags = os.O_RDWR | os.O_CREAT | (os.O_TRUNC if offset is None else 0)
+        fd = os.open(outfile, flags, 0o644)
+        try:
+            fetched = fetch_range(
+                url,
+                fd,
+                0,
+                None,
+                session,
+                counted(check.feed if check is not None else None),
+                shift=shift,
+            )
+            if expected is not None and fetched != expected:  # size was unknown
+                raise IOError(
+                    "{} is {} bytes, the metadata gives {}".format(
+                        url, fetched, expected
+                    )
+                )
+            if check is not None:
+                check.finish(fd, fetched, shift)
+            return fetched
+        finally:
+            os.close(fd)
+    fd = os.open(outfile, os.O_RDWR | os.O_CREAT, 0o644)
+    state = None
+    try:
+        state = SegmentState.load(statefile, url, size)
+        st = os.fstat(fd)
+        if state is not None and (
+            st.st_size < shift + size or state.inode not in (None, st.st_ino)
+        ):
+            state = None  # the file is not the one of the state, eg: removed
+        if state is None:
+            done = st.st_size
+            if done > size or offset is not None:
+                done = 0
+            parts = []
+            if done < size:
+                parts = [
+                    (done + start, done + start, done + end)
+                    for start, end in split_ranges(size - done, segments)
+                ]
+            state = SegmentState(statefile, url, size, parts, st.st_ino)
+            state.save()
+            if done < size:  # else already complete, eg: fetched by wget
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, shift + done, size - done)
+                elif os.fstat(fd).st_size < shift + size:
+                    os.ftruncate(fd, shift + size)
+        if on_allocated is not None:
+            on_allocated()
+        todo = [
+            (i, done, end) for i, (start, done, end) in enumerate(state.parts)
+            if done < end
+        ]
+        fetched = 0
+        if len(todo) == 1:
+            i, done, end = todo[0]
+            fetched = fetch_range(
+                url,
+                fd,
+                done,
+                end,
+                session,
+                counted(state.tracker(i, check)),
+                shift=shift,
+            )
+        elif todo:
+            with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+                futures = [
+                    pool.submit(
+                        fetch_range,
+                        url,
+                        fd,
+                        done,
+                        end,
+                        session,
+                        counted(state.tracker(i, check)),
+                        shift=shift,
+                    )
+                    for i, done, end in todo
+                ]
+                fetched = sum(future.result() for future in futures)
+        if offset is None:
+            os.ftruncate(fd, size)
+        if check is not None:
+            check.finish(fd, size, shift)
+    except BaseException:
+        if state is not None:
+            state.save()
+        raise
+    finally:
+        os.close(fd)
+    if offset is None:
+        state.remove()
+    else:
+        state.save()
+    return fetched
+
+
+def prefetch_dl(args, table, map_dict):
+    """Use the NCBI prefetch program to download the data, `args.jobs` runs at a
+    time. With --convert, each .sra is handed to a pool of `args.convert_jobs`
+    fasterq-dump/pigz workers as soon as it lands, so that the conversion of the
+    first runs overlaps the download of the next ones. Exit with an error once
+    they are all over if some failed"""
+    assert len(set(map_dict.values())) == len(map_dict.keys()), "Non unique sample name"
+    tools = ["prefetch"] + (["fasterq-dump", "pigz"] if args.convert else [])
+    for tool in tools:
+        if shutil.which(tool) is None:
+            raiseError(
+                "  > ERROR: {} not found, please install and try again !".format(tool)
+            )
+    if args.ascp and args.ascp_bin is None:
+        raiseError("  > ERROR: ascp not found, please install and try again !")
+    store = Store.from_args(args)
+    queue = WorkQueue.from_args(args)
+    srrs = [table.runs[i] for i in table.select(args.samples)]
+    srrs = [srr for srr in srrs if in_shard(args, map_dict[srr])]
+
+    def task(srr):
+        return outpath(args, map_dict[srr] + ".sra")
+
+    def fetch(srr):
+        """Prefetch a run, put it under its sample name and queue its conversion.
+        The code is None when another process has it"""
+        if queue is not None and not queue.claim(task(srr)):
+            return None, None, None
+        outfile = task(srr)
+        cmd = None
+        stored = store.lookup(srr, "", ".sra") if store is not None else None
+        if manifest.is_done(outfile, srr):
+            echo(" > {} already downloaded, skipping".format(outfile))
+            ret = 0
+        elif stored is not None and store.link(stored, outfile):
+            echo(" > {} linked from the store".format(outfile))
+            md5 = os.path.basename(stored)[: -len(".sra")]
+            manifest.add(outfile, srr, os.path.getsize(outfile), md5)
+            ret = 0
+        else:
+            cmd = ["prefetch", "-v", "-X", "100GB", "-O", args.outdir or "."]
+            if args.ascp:
+                cmd += ["-t", "ascp", "-a", args.ascp_bin + "|" + args.asperakey]
+            cmd.append(srr)
+            start = time.time()
+            ret = call(cmd)
+            if ret == 0:
+                ret = place_sra(args, srr, outfile)
+            size = 0
+            if ret == 0:
+                size = os.path.getsize(outfile)
+                md5 = file_md5(outfile)
+                manifest.add(outfile, srr, size, md5)
+                if store is not None:
+                    store.put(outfile, srr, md5, ".sra")
+            duration = time.time() - start
+            events.emit(
+                "prefetch",
+                file=outfile,
+                run=srr,
+                bytes=size,
+                duration=round(duration, 3),
+                throughput=round(size / duration, 1) if duration else None,
+                exit=ret,
+                retries=0,
+            )
+        conversion = None
+        if ret == 0 and args.convert:
+            if converted(srr, outfile):
+                echo(" > {} already converted, skipping".format(outfile))
+            else:
+                conversion = convert_pool.submit(convert, srr, outfile)
+        return cmd, ret, conversion
+
+    def converted(srr, sra):
+        """Whether the fastq of `sra` are all in the manifest"""
+        fastqs = [fq for fq in fastq_names(sra) if fq in manifest.entries]
+        return bool(fastqs) and all(manifest.is_done(fq, srr) for fq in fastqs)
+
+    def convert(srr, sra):
+        start = time.time()
+        cmds, ret = sra_to_fastq(args, sra)
+        if ret == 0:
+            for fq in fastq_names(sra):
+                if os.path.exists(fq):
+                    manifest.add(fq, srr, os.path.getsize(fq), "")
+        events.emit(
+            "convert",
+            file=sra,
+            run=srr,
+            duration=round(time.time() - start, 3),
+            exit=ret,
+        )
+        return cmds, ret
+
+    failed = []
+    fetch_pool = ThreadPoolExecutor(max_workers=args.jobs)
+    convert_pool = ThreadPoolExecutor(max_workers=args.convert_jobs)
+    events = EventLog.of(args)
+    if queue is not None:
+        queue.add(dict((task(srr), 1) for srr in srrs))
+    with open(outpath(args, "geoDL.logs"), "a") as log:
+        log.write(log_header(args))
+        futures, conversions = [], []
+        try:
+            todo = srrs
+            while todo:  # more than once to take over from other processes
+                manifest = Manifest(outpath(args, MANIFEST))
+                conversions = []
+                futures = [fetch_pool.submit(fetch, srr) for srr in todo]
+                for srr, future in zip(todo, futures):
+                    cmd, ret, conversion = future.result()
+                    if ret is None:
+                        continue
+                    if cmd is not None:
+                        if ret != 0:
+                            log.write("FAILED ({}) ".format(ret))
+                        log.write(" ".join(cmd) + "\n")
+                        log.flush()
+                    if ret != 0:
+                        failed.append(srr)
+                    if conversion is not None:
+                        conversions.append((srr, conversion))
+                    elif queue is not None:
+                        queue.finish(task(srr), ret == 0)
+                for srr, conversion in conversions:
+                    cmds, ret = conversion.result()
+                    if ret != 0:
+                        log.write("FAILED ({}) ".format(ret))
+                    log.write(" && ".join(" ".join(cmd) for cmd in cmds) + "\n")
+                    log.flush()
+                    if ret != 0:
+                        failed.append(srr)
+                    if queue is not None:
+                        queue.finish(task(srr), ret == 0)
+                todo = queue.waiting(srrs, task) if queue is not None else []
+        finally:
+            for future in futures + [c for _, c in conversions]:
+                future.cancel()
+            fetch_pool.shutdown(wait=False)
+            convert_pool.shutdown(wait=False)
+    if queue is not None:
+        echo("\n".join([""] + queue.report()))
+    if failed:
+        raiseError(
+            "  > ERROR: {} of {} runs failed: {}".format(
+                len(failed), len(srrs), " ".join(failed)
+            )
+        )
+
+
+def place_sra(args, srr, outfile):
+    """Move the file prefetch wrote for `srr` to `outfile`, return 0 when found"""
+    folder = os.path.join(args.outdir, srr)
+    for candidate in [
+        os.path.join(folder, srr + ".sra"),
+        os.path.join(folder, srr + ".sralite"),
+        folder + ".sra",
+        folder,
+    ]:
+        if os.path.isfile(candidate):
+            os.rename(candidate, outfile)
+            if os.path.isdir(folder) and not os.listdir(folder):
+                os.rmdir(folder)
+            return 0
+    echo(Fore.RED + "  > ERROR: prefetch left no file for {}".format(srr) + Fore.RESET)
+    return 1
+
+
+def fastq_names(sra):
+    """The gzipped fastq sra_to_fastq can make of `sra`"""
+    name = sra[: -len(".sra")]
+    return [name + "_R1.fq.gz", name + "_R2.fq.gz", name + ".fq.gz"]
+
+
+def sra_to_fastq(args, sra):
+    """Convert a .sra file to gzipped fastq named like the ENA downloads
+    (<name>_R1.fq.gz and <name>_R2.fq.gz, or <name>.fq.gz). Return the commands
+    run and the return code"""
+    name = sra[: -len(".sra")]
+    folder, base = os.path.split(name)
+    dump = [
+        "fasterq-dump",
+        "--split-3",
+        "-e",
+        str(args.threads),
+        "-t",
+        folder or ".",
+        "-O",
+        folder or ".",
+        "-o",
+        base + ".fastq",
+        sra,
+    ]
+    echo(Fore.GREEN + "\n > Converting {}...".format(sra) + Fore.RESET)
+    ret = call(dump)
+    if ret != 0:
+        return [dump], ret
+    renames = {
+        name + "_1.fastq": name + "_R1.fq.gz",
+        name + "_2.fastq": name + "_R2.fq.gz",
+        name + ".fastq": name + ".fq.gz",
+    }
+    fastqs = [fq for fq in sorted(renames) if os.path.exists(fq)]
+    if not fastqs:  # pigz without files would read stdin
+        echo(
+            Fore.RED
+            + "  > ERROR: fasterq-dump wrote no fastq for {}".format(sra)
+            + Fore.RESET
+        )
+        return [dump], 1
+    gzip = ["pigz", "-f", "-p", str(args.threads)] + fastqs
+    ret = call(gzip)
+    if ret == 0:
+        for fq in fastqs:
+            os.rename(fq + ".gz", renames[fq])
+    return [dump, gzip], ret
+
+
+def read_accessions(inputvalue):
+    """Return the (mode, input) pairs listed in a file, or stdin with -"""
+    f = sys.stdin if inputvalue == "-" else open(inputvalue)
+    entries = []
+    try:
+        for line in f:
+            sp = line.split("#")[0].split()
+            if not sp:
+                continue
+            if len(sp) == 1:
+                mode = "geo" if sp[0].upper().startswith("GSE") else "ena"
+                entries.append((mode, sp[0]))
+            elif sp[0] in ("geo", "ena", "meta") and len(sp) == 2:
+                entries.append((sp[0], sp[1]))
+            else:
+                raiseError("  > ERROR: Cannot understand the line {}".format(line))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return entries
+
+
+def batch_dl(args):
+    """Resolve the metadata of many series concurrently, then download all their
+    files through one queue and print a combined summary"""
+    entries = read_accessions(args.inputvalue)
+    echo("Batch mode: {} series to resolve...".format(len(entries)))
+    cache = MetaCache.from_args(args)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    errors = {}
+
+    with open(outpath(args, "geoDL.logs"), "a") as log:
+        log.write(log_header(args))
+
+        def resolve(entry):
+            sub = argparse.Namespace(**vars(args))
+            sub.mode, sub.inputvalue = entry
+            series = os.path.splitext(os.path.basename(sub.inputvalue))[0]
+            sub.outdir = outpath(args, series)
+            try:
+                metafile, map_dict = get_metadata(sub, cache)
+                table = MetaTable(metafile, sub.colname)
+                transfers = plan_downloads(sub, table, map_dict, log)
+            except GeoDLError as e:
+                echo(Fore.RED + str(e) + Fore.RESET)
+                errors[sub.inputvalue] = "metadata"
+                return []
+            except (IOError, OSError) as e:
+                echo(Fore.RED + "  > ERROR: {}".format(e) + Fore.RESET)
+                errors[sub.inputvalue] = "metadata"
+                return []
+            return transfers
+
+        transfers = []
+        with ThreadPoolExecutor(max_workers=max(args.jobs, 4)) as pool:
+            for planned in pool.map(resolve, entries):
+                transfers.extend(planned)
+        if args.dry:
+            write_plan(args, transfers)
+            return
+        skipped, failed = download(args, transfers, log)
+    batch_summary(args, entries, transfers, skipped, failed, errors)
+    if failed or errors:
+        raiseError(
+            "  > ERROR: {} downloads and {} series failed".format(
+                len(failed), len(errors)
+            )
+        )
+
+
+def batch_summary(args, entries, transfers, skipped, failed, errors):
+    """Print and write to geoDL.summary.tsv how each series went"""
+    header = ["series", "files", "downloaded", "skipped", "failed", "GB"]
+    rows = []
+    for mode, series in entries:
+        mine = [t for t in transfers if t.series == series]
+        nskip = len([t for t in skipped if t.series == series])
+        nfail = len([t for t in failed if t.series == series])
+        size = sum(
+            os.path.getsize(t.outfile) for t in mine if os.path.exists(t.outfile)
+        )
+        if series in errors:
+            row = [series, "-", "-", "-", errors[series], "-"]
+        else:
+            row = [
+                series,
+                str(len(mine)),
+                str(len(mine) - nskip - nfail),
+                str(nskip),
+                str(nfail),
+                "{:.2f}".format(size / 1024.0 ** 3),
+            ]
+        rows.append(row)
+    with open(outpath(args, "geoDL.summary.tsv"), "w") as f:
+        for row in [header] + rows:
+            f.write("\t".join(row) + "\n")
+    echo(Fore.BLUE + "\nSummary:" + Fore.RESET)
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        line = "  ".join(c.ljust(w) for c, w in zip(row, widths))
+        if row is not header and row[4] != "0":
+            line = Fore.RED + line + Fore.RESET
+        echo("  " + line)
+
+
+def resolve(inputvalue, mode="geo", **options):
+    """Yield the Run of a series (geo), a study (ena) or a metadata file (meta).
+    The metadata file is fetched and loaded, and checked as a whole, before the
+    first one; the Run are then made one at a time. `options` are the ones of
+    make_args"""
+    if mode not in ("geo", "ena", "meta"):
+        raise ValueError("resolve() takes a geo, ena or meta input, not " + mode)
+    args = make_args(mode, inputvalue, **options)
+    metafile, map_dict = get_metadata(args)
+    table = MetaTable(metafile, args.colname)
+    for run in table_runs(args, table, map_dict):
+        yield run
+
+
+def plan(runs, **options):
+    """The Plan downloading the files of the `runs`, eg: from resolve().
+    `options` are the ones of make_args, without the progress line by default"""
+    options.setdefault("progress", False)
+    args = make_args("meta", "", **options)
+    runs = list(runs)
+    return Plan(args, runs, plan_runs(args, runs))
+
+
+class Plan(object):
+    """The transfers of some runs, to inspect or download"""
+
+    def __init__(self, args, runs, transfers):
+        self.args = args
+        self.runs = runs
+        self.transfers = transfers
+        self.samples = {}  # sample name -> its transfers, in order
+        for transfer in transfers:
+            name = transfer.name
+            if transfer.mate is not None:  # paired end: without _R1 or _R2
+                name = name[: -len("_R1")]
+            self.samples.setdefault(name, []).append(transfer)
+
+    def __iter__(self):
+        return iter(self.transfers)
+
+    def __len__(self):
+        return len(self.transfers)
+
+    def download(self, by_sample=False):
+        """Download the files, yielding (transfer, return code) pairs as each one
+        is over, the ones already downloaded first with 0. With `by_sample`,
+        yield (sample name, transfers, ok) once all the files of a sample are"""
+        args = self.args
+        if not os.path.isdir(args.outdir):
+            os.makedirs(args.outdir)
+        manifest = Manifest(outpath(args, MANIFEST))
+        store = Store.from_args(args)
+        todo, skipped = pending(self.transfers, manifest, store)
+        done = [(transfer, 0) for transfer in skipped]
+        events = itertools.chain(
+            done, run_transfers(args, todo, manifest, ordered=False, store=store)
+        )
+        if not by_sample:
+            for event in events:
+                yield event
+            return
+        sample_of = {}
+        for name, transfers in self.samples.items():
+            for transfer in transfers:
+                sample_of[id(transfer)] = name
+        left = {name: len(transfers) for name, transfers in self.samples.items()}
+        ok = dict.fromkeys(self.samples, True)
+        for transfer, ret in events:
+            name = sample_of[id(transfer)]
+            left[name] -= 1
+            ok[name] = ok[name] and ret == 0
+            if not left[name]:
+                yield name, self.samples[name], ok[name]
 
 
 def main():
-    print(Fore.BLUE + logo + Fore.RESET)
     args = get_args()
-    metafile, map_dict = get_metadata(args)
-    if args.mode == "prefetch":
-        prefetch_dl(args, metafile, map_dict)
-    else:
-        ena_dl(args, metafile, map_dict)
-    print(Fore.BLUE + "\nIt's over, it's done!\n" + Fore.RESET)
+    # the messages stay out of a plan written to stdout
+    handler = logging.StreamHandler(sys.stderr if args.plan_out == "-" else sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    echo(Fore.BLUE + logo + Fore.RESET)
+    try:
+        if args.mode == "batch":
+            batch_dl(args)
+        else:
+            metafile, map_dict = get_metadata(args)
+            table = MetaTable(metafile, args.colname)
+            if args.mode == "prefetch":
+                prefetch_dl(args, table, map_dict)
+            else:
+                ena_dl(args, table, map_dict)
+    except GeoDLError as e:
+        echo(Fore.RED + str(e) + Fore.RESET)
+        sys.exit(1)
+    finally:
+        print_stats(args)
+    echo(Fore.BLUE + "\nIt's over, it's done!\n" + Fore.RESET)
+
+
+def print_stats(args):
+    """The --stats report, also shown when the run stops on an error"""
+    if args.stats and getattr(args, "events", None) is not None:
+        echo(Fore.BLUE + "\n".join([""] + args.events.summary()) + Fore.RESET)
 
 
 if __name__ == "__main__":
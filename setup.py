@@ -49,9 +49,10 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
+    python_requires='>=3.6',
 
     # What does your project relate to?
     keywords='geo ncbi fastq bioinformatic genomic sra',
@@ -69,7 +70,7 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['colorama', 'beautifulsoup4', 'six', 'lxml', "requests"],
+    install_requires=['colorama', 'beautifulsoup4', 'lxml', "requests"],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
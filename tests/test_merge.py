@@ -0,0 +1,114 @@
+"""--merge: the runs of a sample are written at their offset in one file"""
+import functools
+import gzip
+import hashlib
+import os
+import re
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import geoDL
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Serve the files with byte ranges, like the ENA servers"""
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        with open(path, "rb") as f:
+            body = f.read()
+        m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if m:
+            start = int(m.group(1))
+            end = int(m.group(2)) + 1 if m.group(2) else len(body)
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end - 1, len(body))
+            )
+            body = body[start:end]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return _Body(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Body(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, *args):
+        data, self.data = self.data, b""
+        return data
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "srv"
+    root.mkdir()
+    handler = functools.partial(RangeHandler, directory=str(root))
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield root, "127.0.0.1:{}".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def merged_plan(tmp_path, server, skew=0):
+    """Two runs of the sample S, the size of the first one off by `skew` in the
+    metadata"""
+    root, host = server
+    files = []
+    for i in range(2):
+        data = gzip.compress(os.urandom(50000) + b"run %d" % i)
+        (root / "f{}.fq.gz".format(i)).write_bytes(data)
+        files.append(data)
+    rows = ["run_accession\tsample_alias\tfastq_ftp\tfastq_bytes\tfastq_md5"]
+    for i, data in enumerate(files):
+        size = len(data) + (skew if i == 0 else 0)
+        rows.append(
+            "SRR{0}\tS\t{1}/f{0}.fq.gz\t{2}\t{3}".format(
+                i, host, size, hashlib.md5(data).hexdigest()
+            )
+        )
+    metafile = tmp_path / "meta.tsv"
+    metafile.write_text("\n".join(rows) + "\n")
+    outdir = tmp_path / "out"
+    options = dict(merge=True, engine="native", protocol="http", segments=2)
+    runs = geoDL.resolve(str(metafile), mode="meta", **options)
+    return geoDL.plan(runs, outdir=str(outdir), **options), files, outdir
+
+
+def manifest_entries(outdir):
+    path = outdir / "geoDL.manifest"
+    if not path.exists():
+        return []
+    return [line.split("\t")[1] for line in path.read_text().splitlines()[1:]]
+
+
+def test_merge(tmp_path, server):
+    plan, files, outdir = merged_plan(tmp_path, server)
+    assert [ret for _, ret in plan.download()] == [0, 0]
+    assert (outdir / "S.fq.gz").read_bytes() == b"".join(files)
+    assert manifest_entries(outdir) == ["SRR0+SRR1"]
+
+
+def test_merge_wrong_size(tmp_path, server):
+    # the offset of the second run comes from the size of the first one
+    plan, _, outdir = merged_plan(tmp_path, server, skew=1000)
+    codes = {transfer.run: ret for transfer, ret in plan.download()}
+    assert codes["SRR0"] != 0
+    assert manifest_entries(outdir) == []